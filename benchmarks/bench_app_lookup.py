@@ -0,0 +1,42 @@
+#!/usr/bin/env python
+"""Measures the cost of ``Environment._app`` for an unbound environment,
+compared to probing the request and app context stacks one after another.
+
+Run with ``python benchmarks/bench_app_lookup.py``.
+"""
+
+import sys
+import timeit
+from os import path
+sys.path.insert(0, path.join(path.dirname(__file__), '../src'))
+
+from flask import Flask, has_app_context, has_request_context
+from flask.globals import app_ctx, request_ctx
+
+from flask_assets import Environment
+
+
+def probe_stacks():
+    if has_request_context():
+        return request_ctx.app
+    if has_app_context():
+        return app_ctx.app
+
+
+def main(number=200000):
+    app = Flask(__name__)
+    env = Environment()
+    env.init_app(app)
+
+    for name, ctx in (('app context', app.app_context()),
+                      ('request context', app.test_request_context())):
+        with ctx:
+            for label, stmt in (('Environment._app', lambda: env._app),
+                                ('stack probing', probe_stacks)):
+                best = min(timeit.repeat(stmt, number=number, repeat=5))
+                print('%-16s %-18s %6.1f ns/access' % (
+                    name, label, best / number * 1e9))
+
+
+if __name__ == '__main__':
+    main()
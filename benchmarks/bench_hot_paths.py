@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+"""Measures the hot paths of Flask-Assets: ``FlaskResolver.search_for_source``,
+``FlaskResolver.convert_item_to_flask_url``, ``FlaskConfigStorage.__getitem__``
+and the rendering of an ``{% assets %}`` tag, for different numbers of
+blueprints and bundle sizes, with bound and unbound environments, inside
+and outside of a request.
+
+Run with ``python benchmarks/bench_hot_paths.py``; pass ``--json`` to get
+machine-readable results, which can be stored to track regressions.
+"""
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import timeit
+from os import path
+sys.path.insert(0, path.join(path.dirname(__file__), '../src'))
+
+import flask
+import webassets
+from flask import Blueprint, Flask
+from webassets.bundle import wrap
+
+from flask_assets import Bundle, Environment
+
+try:
+    from importlib.metadata import version
+except ImportError:
+    version = None
+
+
+def create_app(root, blueprints, files, bound):
+    """Create an app with ``blueprints`` blueprints, and a bundle ``js``
+    of ``files`` files spread over the app and its blueprints.
+    """
+    static = path.join(root, 'static')
+    os.makedirs(static)
+    app = Flask(__name__, static_folder=static, static_url_path='/static')
+    for i in range(blueprints):
+        folder = path.join(root, 'bp%d' % i)
+        os.makedirs(folder)
+        app.register_blueprint(Blueprint(
+            'bp%d' % i, __name__, static_folder=folder,
+            static_url_path='/bp%d_static' % i))
+
+    items = []
+    for i in range(files):
+        if blueprints and i % 2:
+            prefix = 'bp%d' % (i % blueprints)
+            folder = path.join(root, prefix)
+        else:
+            prefix, folder = None, static
+        filename = 'file%d.js' % i
+        with open(path.join(folder, filename), 'w') as f:
+            f.write('var v%d;\n' % i)
+        items.append('%s/%s' % (prefix, filename) if prefix else filename)
+
+    app.config['ASSETS_DEBUG'] = False
+    app.config['ASSETS_URL_EXPIRE'] = False
+    if bound:
+        env = Environment(app)
+    else:
+        env = Environment()
+        env.init_app(app)
+    env.register('js', Bundle(*items, output='gen/packed.js'))
+    return app, env, items
+
+
+def measure(stmt, number):
+    best = min(timeit.repeat(stmt, number=number, repeat=5))
+    return best / number * 1e9
+
+
+def run_scenario(app, env, items, number):
+    results = {}
+    ctx = wrap(env, env['js'])
+    resolver = env.resolver
+    item = items[-1]
+    filepath = resolver.search_for_source(ctx, item)
+    template = app.jinja_env.from_string(
+        "{% assets 'js' %}{{ ASSET_URL }}{% endassets %}")
+
+    results['search_for_source'] = measure(
+        lambda: resolver.search_for_source(ctx, item), number)
+    results['convert_item_to_flask_url'] = measure(
+        lambda: resolver.convert_item_to_flask_url(ctx, item, filepath),
+        number)
+    results['config_getitem'] = measure(lambda: env.config['debug'], number)
+
+    # Renders with a built bundle, and in debug mode, with one url per file.
+    template.render()
+    results['render'] = measure(template.render, max(number // 100, 10))
+    app.config['ASSETS_DEBUG'] = True
+    try:
+        results['render_debug'] = measure(
+            template.render, max(number // 100, 10))
+    finally:
+        app.config['ASSETS_DEBUG'] = False
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--json', action='store_true',
+                        help='print the results as JSON')
+    parser.add_argument('--number', type=int, default=20000,
+                        help='number of calls per measurement')
+    parser.add_argument('--blueprints', type=int, nargs='+',
+                        default=[0, 10, 100])
+    parser.add_argument('--files', type=int, nargs='+', default=[1, 10, 100])
+    args = parser.parse_args()
+
+    records = []
+    for blueprints in args.blueprints:
+        for files in args.files:
+            for bound in (True, False):
+                root = tempfile.mkdtemp()
+                try:
+                    app, env, items = create_app(root, blueprints, files,
+                                                 bound)
+                    for in_request in (False, True):
+                        ctx = app.test_request_context() if in_request \
+                            else app.app_context()
+                        with ctx:
+                            results = run_scenario(app, env, items,
+                                                   args.number)
+                        for name, ns in sorted(results.items()):
+                            records.append({
+                                'benchmark': name,
+                                'blueprints': blueprints,
+                                'files': files,
+                                'bound': bound,
+                                'request': in_request,
+                                'ns_per_call': round(ns, 1),
+                            })
+                finally:
+                    shutil.rmtree(root, ignore_errors=True)
+
+    if args.json:
+        json.dump({
+            'python': platform.python_version(),
+            'flask': version('flask') if version else flask.__version__,
+            'webassets': webassets.__version__,
+            'results': records,
+        }, sys.stdout, indent=2)
+        print()
+        return
+
+    print('%-26s %10s %6s %6s %8s %14s' % (
+        'benchmark', 'blueprints', 'files', 'bound', 'request', 'ns/call'))
+    for r in records:
+        print('%-26s %10d %6d %6s %8s %14.1f' % (
+            r['benchmark'], r['blueprints'], r['files'], r['bound'],
+            r['request'], r['ns_per_call']))
+
+
+if __name__ == '__main__':
+    main()
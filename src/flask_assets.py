@@ -2,7 +2,32 @@
 
 from __future__ import print_function
 
+import ast
+import asyncio
+import contextvars
+import gzip
+import hashlib
+import io
+import json
 import logging
+import mimetypes
+import mmap
+import os
+import re
+import select
+import struct
+import sys
+import tempfile
+import threading
+import time
+import weakref
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import partial
+from glob import has_magic
+from importlib.util import find_spec
+from itertools import chain
 from os import path
 
 try:
@@ -11,14 +36,36 @@ except ImportError:
     from flask import _request_ctx_stack, _app_ctx_stack
     request_ctx = _request_ctx_stack.top
     app_ctx = _app_ctx_stack.top
-from flask import current_app, has_app_context, has_request_context
-from flask.templating import render_template_string
-# We want to expose Bundle via this module.
-from webassets import Bundle
+try:
+    # Flask >= 2.2 keeps the contexts in context variables.
+    from flask.globals import _cv_app
+except ImportError:
+    _cv_app = None
+from flask import (Blueprint, abort, current_app, has_app_context,
+                   has_request_context, request, send_from_directory)
+from flask.signals import Namespace, before_render_template, template_rendered
+from webassets import Bundle as BaseBundle
+from webassets.bundle import get_all_bundle_files, has_placeholder, wrap
 from webassets.env import (BaseEnvironment, ConfigStorage, Resolver,
                            env_options, url_prefix_join)
+from webassets.exceptions import BuildError, BundleError
+from webassets.ext.jinja2 import AssetsExtension
 from webassets.filter import Filter, register_filter
 from webassets.loaders import PythonLoader, YAMLLoader
+from webassets.merge import MemoryHunk
+from webassets.updater import SKIP_CACHE, BaseUpdater
+from webassets.utils import calculate_sri, hash_func, is_url
+from werkzeug.security import safe_join
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
 __version__ = (2, 1, 1, 'dev')
 # webassets core compatibility used in setup.py
@@ -27,32 +74,140 @@ __webassets_version__ = ('>=2.0', )
 __all__ = (
     'Environment',
     'Bundle',
+    'ContentHashUpdater',
     'FlaskConfigStorage',
     'FlaskResolver',
     'Jinja2Filter',
+    'MemoryStore',
+    'UrlBackend',
 )
 
 
+# Options specific to Flask-Assets. Like the webassets ``env_options``, they
+# are stored in the Flask config with an ``ASSETS_`` prefix.
+flask_env_options = [
+    'url_cache_size', 'url_manifest', 'url_backend', 'hash_outputs',
+    'precompress', 'serve_precompressed', 'in_memory', 'in_memory_url',
+    'in_memory_spill_size', 'prewarm', 'build_file_lock',
+]
+
+
+_signals = Namespace()
+
+# Sent by an environment when it starts to build a bundle, with the
+# bundle as ``bundle``.
+bundle_build_started = _signals.signal('bundle-build-started')
+# Sent by an environment when a build finished, with the ``bundle``, the
+# ``duration`` in seconds, the size of the inputs and the output in bytes
+# (``bytes_in``, ``bytes_out``), and the ``exception`` if it failed.
+bundle_build_finished = _signals.signal('bundle-build-finished')
+# Sent by an environment when a url is found in the url cache of
+# FlaskResolver, or not, with the ``item`` and the ``url``.
+url_cache_hit = _signals.signal('url-cache-hit')
+url_cache_missed = _signals.signal('url-cache-missed')
+# Sent by an environment when FlaskResolver generated the ``url`` of an
+# ``item``, taking ``duration`` seconds.
+url_resolved = _signals.signal('url-resolved')
+
+
+def _gzip_compress(data):
+    # A fixed mtime makes the output reproducible.
+    return gzip.compress(data, 9, mtime=0)
+
+
+# The encodings in which outputs can be precompressed, in order of
+# preference, mapping to (file extension, compress function).
+precompress_encodings = OrderedDict([
+    ('br', ('.br', brotli and brotli.compress)),
+    ('gzip', ('.gz', _gzip_compress)),
+])
+
+
 class Jinja2Filter(Filter):
     """Will compile all source files as Jinja2 templates using the standard
     Flask contexts.
+
+    Compiled templates are cached by the hash of their source, so that each
+    source is compiled only once for each Jinja2 environment. If a
+    ``bytecode_cache`` is given, or one is configured on the Jinja2
+    environment of the app, the compiled code is also stored there.
+
+    With ``stream`` enabled (or ``JINJA2_STREAM`` set in the config), the
+    output is written in chunks as it is rendered, rather than as a single
+    string, which reduces the memory needed for large files.
     """
     name = 'jinja2'
     max_debug_level = None
+    options = {
+        'stream': 'JINJA2_STREAM',
+    }
+
+    # The number of compiled templates to keep for each Jinja2 environment.
+    template_cache_size = 256
 
-    def __init__(self, context=None):
-        super(Jinja2Filter, self).__init__()
+    _templates = weakref.WeakKeyDictionary()
+    _templates_lock = threading.Lock()
+
+    def __init__(self, context=None, bytecode_cache=None, stream=None):
+        super(Jinja2Filter, self).__init__(stream=stream)
         self.context = context or {}
+        self.bytecode_cache = bytecode_cache
+
+    def get_template(self, jinja_env, source):
+        """Return the compiled template for ``source``."""
+        key = hashlib.sha1(source.encode('utf-8')).hexdigest()
+        with self._templates_lock:
+            templates = self._templates.get(jinja_env)
+            if templates is None:
+                templates = self._templates[jinja_env] = OrderedDict()
+            template = templates.get(key)
+            if template is not None:
+                templates.move_to_end(key)
+                return template
+
+        template = self.compile_template(jinja_env, source, key)
+        with self._templates_lock:
+            templates[key] = template
+            while len(templates) > self.template_cache_size:
+                templates.popitem(last=False)
+        return template
+
+    def compile_template(self, jinja_env, source, key):
+        bytecode_cache = self.bytecode_cache or jinja_env.bytecode_cache
+        if bytecode_cache is None:
+            return jinja_env.from_string(source)
+
+        bucket = bytecode_cache.get_bucket(jinja_env, key, None, source)
+        if bucket.code is None:
+            bucket.code = jinja_env.compile(source)
+            bytecode_cache.set_bucket(bucket)
+        return jinja_env.template_class.from_code(
+            jinja_env, bucket.code, jinja_env.make_globals(None), None)
 
     def input(self, _in, out, source_path, output_path, **kw):
-        out.write(render_template_string(_in.read(), **self.context))
+        # This does what render_template_string() does, with a cached
+        # template.
+        app = current_app._get_current_object()
+        template = self.get_template(app.jinja_env, _in.read())
+        context = dict(self.context)
+        app.update_template_context(context)
+        before_render_template.send(app, template=template, context=context)
+        if self.stream:
+            for chunk in template.generate(context):
+                out.write(chunk)
+        else:
+            out.write(template.render(context))
+        template_rendered.send(app, template=template, context=context)
 
 # Override the built-in ``jinja2`` filter that ships with ``webassets``. This
-# custom filter uses Flask's ``render_template_string`` function to provide all
-# the standard Flask template context variables.
+# custom filter renders like Flask's ``render_template_string`` function, to
+# provide all the standard Flask template context variables.
 register_filter(Jinja2Filter)
 
 
+_missing = object()
+
+
 class FlaskConfigStorage(ConfigStorage):
     """Uses the config object of a Flask app as the backend: either the app
     instance bound to the extension directly, or the current Flask app on
@@ -70,13 +225,23 @@ class FlaskConfigStorage(ConfigStorage):
 
     def __init__(self, *a, **kw):
         self._defaults = {}
+        # Memoized results of _transform_key(). The results of looking up
+        # keys which are not in the app config are memoized in the state
+        # the environment keeps for each app.
+        self._keys = {}
         ConfigStorage.__init__(self, *a, **kw)
 
     def _transform_key(self, key):
-        if key.lower() in env_options:
-            return "ASSETS_%s" % key.upper()
+        try:
+            return self._keys[key]
+        except KeyError:
+            pass
+        if key.lower() in env_options or key.lower() in flask_env_options:
+            public_key = "ASSETS_%s" % key.upper()
         else:
-            return key.upper()
+            public_key = key.upper()
+        self._keys[key] = public_key
+        return public_key
 
     def setdefault(self, key, value):
         """We may not always be connected to an app, but we still need
@@ -86,6 +251,8 @@ class FlaskConfigStorage(ConfigStorage):
             super(FlaskConfigStorage, self).setdefault(key, value)
         except RuntimeError:
             self._defaults.__setitem__(key, value)
+            for state in list(self.env._app_states.values()):
+                state.config = None
 
     def __contains__(self, key):
         return self._transform_key(key) in self.env._app.config
@@ -95,12 +262,26 @@ class FlaskConfigStorage(ConfigStorage):
         if value:
             return value
 
-        # First try the current app's config
+        # First try the current app's config. This is always looked up,
+        # so that values written to the config directly are picked up.
+        app = self.env._app
         public_key = self._transform_key(key)
-        if self.env._app:
-            if public_key in self.env._app.config:
-                return self.env._app.config[public_key]
+        if public_key in app.config:
+            return app.config[public_key]
 
+        state = self.env._get_app_state(app)
+        resolved = state.config
+        if resolved is None:
+            resolved = state.config = {}
+        try:
+            value = resolved[key]
+        except KeyError:
+            value = resolved[key] = self._get_default(key)
+        if value is _missing:
+            raise KeyError(key)
+        return value
+
+    def _get_default(self, key):
         # Try a non-app specific default value
         if key in self._defaults:
             return self._defaults.__getitem__(key)
@@ -111,14 +292,18 @@ class FlaskConfigStorage(ConfigStorage):
             return deffunc()
 
         # We've run out of options
-        raise KeyError()
+        return _missing
 
     def __setitem__(self, key, value):
         if not self._set_deprecated(key, value):
-            self.env._app.config[self._transform_key(key)] = value
+            app = self.env._app
+            app.config[self._transform_key(key)] = value
+            self.env._get_app_state(app).config = None
 
     def __delitem__(self, key):
-        del self.env._app.config[self._transform_key(key)]
+        app = self.env._app
+        del app.config[self._transform_key(key)]
+        self.env._get_app_state(app).config = None
 
 
 def get_static_folder(app_or_blueprint):
@@ -140,6 +325,55 @@ def get_static_folder(app_or_blueprint):
     return app_or_blueprint.static_folder
 
 
+class UrlBackend(object):
+    """Generates the urls of static files for :class:`FlaskResolver`.
+
+    Backends are made available with
+    :meth:`FlaskResolver.register_url_backend`, and selected for an app
+    through the ``ASSETS_URL_BACKEND`` setting.
+    """
+
+    def url_for(self, endpoint, filename):
+        """Return the url of ``filename`` served by ``endpoint``."""
+        raise NotImplementedError()
+
+    def urls_for(self, items):
+        """Return the urls for a list of (endpoint, filename) 2-tuples.
+
+        This is used to generate the urls of all the source files of a
+        bundle at once. Backends which can do this more efficiently than
+        one file after another should override it.
+        """
+        return [self.url_for(endpoint, filename)
+                for endpoint, filename in items]
+
+
+class FlaskUrlBackend(UrlBackend):
+    """Uses a ``url_for`` function, by default the one of Flask."""
+
+    def __init__(self, url_for=None):
+        if url_for is None:
+            from flask import url_for
+        self._url_for = url_for
+
+    def url_for(self, endpoint, filename):
+        return self._url_for(endpoint, filename=filename)
+
+
+def _extension_url_backend(module, extension, option):
+    """Return a factory for a backend using the ``url_for`` function of
+    a Flask extension replacing the one of Flask.
+    """
+    def create(app):
+        try:
+            url_for = __import__(module).url_for
+        except ImportError as e:
+            print("You must have %s to use %s option" % (extension, option))
+            raise e
+        return FlaskUrlBackend(url_for)
+    return create
+
+
 class FlaskResolver(Resolver):
     """Adds support for Flask blueprints.
 
@@ -158,29 +392,159 @@ class FlaskResolver(Resolver):
     If a :attr:`Environment.load_path` is set, it is used to look
     up source files, replacing the Flask system. Blueprint prefixes
     are no longer resolved.
+
+    Urls generated through the Flask system are memoized per application,
+    in a cache bounded by the ``ASSETS_URL_CACHE_SIZE`` setting (``0``
+    disables the cache). Use :meth:`clear_url_cache` to invalidate it.
+
+    The urls are generated by a :class:`UrlBackend`, chosen once for
+    each app: the one registered under the name given in the
+    ``ASSETS_URL_BACKEND`` setting (which may also be a backend
+    instance), or otherwise based on the ``FLASK_ASSETS_USE_S3``,
+    ``FLASK_ASSETS_USE_CDN`` and ``FLASK_ASSETS_USE_AZURE`` settings.
     """
 
+    url_backends = {
+        'flask': lambda app: FlaskUrlBackend(),
+        's3': _extension_url_backend(
+            'flask_s3', 'Flask S3', 'FLASK_ASSETS_USE_S3'),
+        'cdn': _extension_url_backend(
+            'flask_cdn', 'Flask CDN', 'FLASK_ASSETS_USE_CDN'),
+        'azure': _extension_url_backend(
+            'flask_azure_storage', 'Flask Azure Storage',
+            'FLASK_ASSETS_USE_AZURE'),
+    }
+
+    def __init__(self):
+        # The memoized urls, url backends and blueprint indexes are kept
+        # in the state the environment keeps for each app.
+        self._url_cache_lock = threading.Lock()
+        # (basedir, expr) => (directories, their mtimes, filenames)
+        self._glob_cache = {}
+
+    @classmethod
+    def register_url_backend(cls, name, factory):
+        """Make a url backend available as ``ASSETS_URL_BACKEND = name``.
+        ``factory`` is called with the app, and returns a
+        :class:`UrlBackend`.
+        """
+        cls.url_backends[name] = factory
+
+    def _get_app_state(self, ctx, app=None):
+        env = getattr(ctx, 'environment', ctx)
+        return env._get_app_state(env._app if app is None else app)
+
+    def get_url_backend(self, ctx, app=None):
+        """Return the :class:`UrlBackend` to use for ``app`` (by default,
+        the current app).
+        """
+        state = self._get_app_state(ctx, app)
+        backend = state.url_backend
+        if backend is None:
+            backend = state.url_backend = self.create_url_backend(
+                app if app is not None else ctx.environment._app)
+        return backend
+
+    def create_url_backend(self, app):
+        name = app.config.get('ASSETS_URL_BACKEND')
+        if name is None:
+            if app.config.get("FLASK_ASSETS_USE_S3"):
+                name = 's3'
+            elif app.config.get("FLASK_ASSETS_USE_CDN"):
+                name = 'cdn'
+            elif app.config.get("FLASK_ASSETS_USE_AZURE"):
+                name = 'azure'
+            else:
+                name = 'flask'
+        if isinstance(name, UrlBackend):
+            return name
+        try:
+            factory = self.url_backends[name]
+        except KeyError:
+            raise EnvironmentError('Unknown url backend: %s' % name)
+        return factory(app)
+
+    def clear_url_cache(self, ctx, app=None):
+        """Forget the memoized urls of ``app``, or of all applications
+        if none is given. The url backend is chosen again as well.
+        """
+        env = getattr(ctx, 'environment', ctx)
+        if app is None:
+            states = list(env._app_states.values())
+        else:
+            states = [env._get_app_state(app)]
+        with self._url_cache_lock:
+            for state in states:
+                state.url_cache = state.url_backend = None
+
+    def _get_cached_url(self, state, key):
+        with self._url_cache_lock:
+            cache = state.url_cache
+            if cache is None or key not in cache:
+                return None
+            cache.move_to_end(key)
+            return cache[key]
+
+    def _set_cached_url(self, state, key, url, size):
+        with self._url_cache_lock:
+            cache = state.url_cache
+            if cache is None:
+                cache = state.url_cache = OrderedDict()
+            cache[key] = url
+            while len(cache) > size:
+                cache.popitem(last=False)
+
+    def get_blueprint_index(self, ctx):
+        """Return a dict mapping the names of the blueprints of ``app``
+        to (static folder, endpoint) 2-tuples. The static folder is
+        ``None`` for blueprints without one.
+
+        The index is built lazily, and rebuilt once further blueprints
+        have been registered.
+        """
+        env = getattr(ctx, 'environment', ctx)
+        app = env._app
+        state = env._get_app_state(app)
+        entry = state.blueprint_index
+        if entry is not None and entry[0] == len(app.blueprints):
+            return entry[1]
+
+        index = {}
+        for name, blueprint in list(app.blueprints.items()):
+            try:
+                directory = get_static_folder(blueprint)
+            except TypeError:
+                directory = None
+            index[name] = (directory, '%s.static' % name)
+        state.blueprint_index = (len(index), index)
+        return index
+
     def split_prefix(self, ctx, item):
         """See if ``item`` has blueprint prefix, return (directory, rel_path).
         """
         app = ctx._app
-        try:
-            if hasattr(app, 'blueprints'):
-                blueprint, name = item.split('/', 1)
-                directory = get_static_folder(app.blueprints[blueprint])
-                endpoint = '%s.static' % blueprint
-                item = name
-            else:
-                # Module support for Flask < 0.7
+        if not hasattr(app, 'blueprints'):
+            # Module support for Flask < 0.7
+            try:
                 module, name = item.split('/', 1)
                 directory = get_static_folder(app.modules[module])
                 endpoint = '%s.static' % module
                 item = name
-        except (ValueError, KeyError):
-            directory = get_static_folder(app)
-            endpoint = 'static'
-
-        return directory, item, endpoint
+            except (ValueError, KeyError):
+                directory = get_static_folder(app)
+                endpoint = 'static'
+            return directory, item, endpoint
+
+        blueprint, sep, name = item.partition('/')
+        entry = self.get_blueprint_index(ctx).get(blueprint) if sep else None
+        if entry is None:
+            return get_static_folder(app), item, 'static'
+
+        directory, endpoint = entry
+        if directory is None:
+            # Raises the appropriate error
+            get_static_folder(app.blueprints[blueprint])
+        return directory, name, endpoint
 
     def use_webassets_system_for_output(self, ctx):
         return ctx.config.get('directory') is not None or \
@@ -206,6 +570,71 @@ class FlaskResolver(Resolver):
             # expect an IOError upon missing files. They need to be rewritten.
             return path.normpath(path.join(directory, item))
 
+    # Directories modified more recently than this (in nanoseconds) may
+    # still change within the resolution of their mtime, so glob results
+    # for them are not cached.
+    glob_cache_min_age = 2 * 10 ** 9
+
+    def glob(self, basedir, expr):
+        """Evaluates a glob expression, like the webassets resolver.
+
+        The results are cached along with the modification times of the
+        directories the expression may need to list, and used while those
+        do not change, i.e. no files have been added, removed or renamed.
+        """
+        key = (basedir, expr)
+        cached = self._glob_cache.get(key)
+        if cached is not None and \
+                self._get_mtimes(cached[0]) == cached[1]:
+            return list(cached[2])
+
+        directories = self._get_glob_directories(basedir, expr)
+        mtimes = self._get_mtimes(directories)
+        result = Resolver.glob(self, basedir, expr)
+        if time.time_ns() - max(m or 0 for m in mtimes) > \
+                self.glob_cache_min_age:
+            self._glob_cache[key] = (directories, mtimes, tuple(result))
+        return result
+
+    def clear_glob_cache(self):
+        """Forget the cached results of :meth:`glob`."""
+        self._glob_cache.clear()
+
+    def _get_glob_directories(self, basedir, expr):
+        """Return the directories that may need to be listed to evaluate
+        the glob expression: the one named by the part of ``expr`` without
+        wildcards, and its subdirectories down to the depth of ``expr``.
+        """
+        parts = path.normpath(expr).replace('\\', '/').split('/')
+        fixed = []
+        for part in parts[:-1]:
+            if has_magic(part):
+                break
+            fixed.append(part)
+        level = [path.join(basedir, *fixed)]
+        directories = list(level)
+        for _ in range(len(parts) - len(fixed) - 1):
+            subdirectories = []
+            for directory in level:
+                try:
+                    subdirectories.extend(
+                        entry.path for entry in os.scandir(directory)
+                        if entry.is_dir())
+                except OSError:
+                    pass
+            directories.extend(subdirectories)
+            level = subdirectories
+        return tuple(directories)
+
+    def _get_mtimes(self, directories):
+        mtimes = []
+        for directory in directories:
+            try:
+                mtimes.append(os.stat(directory).st_mtime_ns)
+            except OSError:
+                mtimes.append(None)
+        return mtimes
+
     def resolve_output_to_path(self, ctx, target, bundle):
         # If a directory/url pair is set, always use it for output files
         if self.use_webassets_system_for_output(ctx):
@@ -223,6 +652,11 @@ class FlaskResolver(Resolver):
         return self.convert_item_to_flask_url(ctx, item, filepath)
 
     def resolve_output_to_url(self, ctx, target):
+        # Outputs kept in memory are served by a blueprint of our own.
+        if ctx.config.get('in_memory'):
+            return self.generate_urls(
+                ctx, [(Environment.in_memory_endpoint, target)])[0]
+
         # With a directory/url pair set, use it for output files.
         if self.use_webassets_system_for_output(ctx):
             return Resolver.resolve_output_to_url(self, ctx, target)
@@ -230,6 +664,13 @@ class FlaskResolver(Resolver):
         # Otherwise, behaves like all other flask URLs.
         return self.convert_item_to_flask_url(ctx, target)
 
+    def _get_url_cache_key(self, app, item, filepath):
+        # The root url of the current request affects the urls url_for()
+        # generates, the registered blueprints how ``item`` is interpreted.
+        return (item, filepath,
+                request.root_url if has_request_context() else None,
+                len(getattr(app, 'blueprints', ())))
+
     def convert_item_to_flask_url(self, ctx, item, filepath=None):
         """Given a relative reference like `foo/bar.css`, returns
         the Flask static url. By doing so it takes into account
@@ -240,63 +681,706 @@ class FlaskResolver(Resolver):
         used instead. This is needed because ``item`` may be a
         glob instruction that was resolved to multiple files.
 
-        If app.config("FLASK_ASSETS_USE_S3") exists and is True
-        then we import the url_for function from flask_s3,
-        otherwise we import url_for from flask directly.
+        The url is generated by the url backend of the app (see
+        :meth:`get_url_backend`), and memoized per application.
+        """
+        env = ctx.environment
+        app = env._app
+        cache_size = env.config.get('url_cache_size')
+        if cache_size:
+            state = env._get_app_state(app)
+            key = self._get_url_cache_key(app, item, filepath)
+            url = self._get_cached_url(state, key)
+            env._record_url_lookup(item, url)
+            if url is not None:
+                return url
+
+        start = time.perf_counter()
+        url = self.convert_items_to_flask_urls(ctx, [(item, filepath)])[0]
+        env._record_url_resolved(item, url, time.perf_counter() - start)
+        if cache_size:
+            self._set_cached_url(state, key, url, cache_size)
+        return url
+
+    def convert_items_to_flask_urls(self, ctx, items):
+        """Like :meth:`convert_item_to_flask_url`, for a list of
+        (item, filepath) 2-tuples, passed to the url backend at once.
+        Nothing is memoized here.
+        """
+        to_generate = []
+        for item, filepath in items:
+            directory, rel_path, endpoint = self.split_prefix(ctx, item)
+            if filepath is not None:
+                filename = filepath[len(directory)+1:]
+            else:
+                filename = rel_path
+            # Windows compatibility
+            filename = filename.replace("\\", "/")
+            to_generate.append((endpoint, filename))
+        return self.generate_urls(ctx, to_generate)
+
+    def generate_urls(self, ctx, to_generate):
+        """Generate the urls for a list of (endpoint, filename) 2-tuples
+        through the url backend, outside of a request if necessary.
+        """
+        backend = self.get_url_backend(ctx)
+        flask_ctx = None
+        if not has_request_context():
+            flask_ctx = ctx.environment._app.test_request_context()
+            flask_ctx.push()
+        try:
+            urls = backend.urls_for(to_generate)
+        finally:
+            if flask_ctx:
+                flask_ctx.pop()
 
-        If app.config("FLASK_ASSETS_USE_CDN") exists and is True
-        then we import the url_for function from flask.
+        # In some cases, url will be an absolute url with a scheme and hostname.
+        # (for example, when using werkzeug's host matching).
+        # In general, url_for() will return a http url. During assets build, we
+        # we don't know yet if the assets will be served over http, https or both.
+        # Let's use // instead. url_for takes a _scheme argument, but only together
+        # with external=True, which we do not want to force every time. Further,
+        # this _scheme argument is not able to render // - it always forces a colon.
+        return [url[5:] if url and url.startswith('http:') else url
+                for url in urls]
+
+    def prefetch_urls(self, ctx, bundle):
+        """Generate the urls of all source files of ``bundle`` and its
+        children in a single call to the url backend, and store them in
+        the url cache.
+
+        This is done before rendering a bundle in debug mode, where a url
+        is needed for each source file.
         """
-        if ctx.environment._app.config.get("FLASK_ASSETS_USE_S3"):
-            try:
-                from flask_s3 import url_for
-            except ImportError as e:
-                print("You must have Flask S3 to use FLASK_ASSETS_USE_S3 option")
-                raise e
-        elif ctx.environment._app.config.get("FLASK_ASSETS_USE_CDN"):
-            try:
-                from flask_cdn import url_for
-            except ImportError as e:
-                print("You must have Flask CDN to use FLASK_ASSETS_USE_CDN option")
-                raise e
-        elif ctx.environment._app.config.get("FLASK_ASSETS_USE_AZURE"):
+        app = ctx.environment._app
+        cache_size = ctx.environment.config.get('url_cache_size')
+        if not cache_size or self.use_webassets_system_for_sources(ctx):
+            return
+
+        items = []
+        bundles = [(ctx, bundle)]
+        while bundles:
+            bundle_ctx, current = bundles.pop(0)
+            for org, cnt in current.resolve_contents(bundle_ctx):
+                if isinstance(cnt, BaseBundle):
+                    bundles.append((wrap(bundle_ctx, cnt), cnt))
+                elif isinstance(cnt, str) and not is_url(cnt):
+                    items.append((org, cnt))
+
+        state = ctx.environment._get_app_state(app)
+        missing = []
+        for item, filepath in items[:cache_size]:
+            key = self._get_url_cache_key(app, item, filepath)
+            if self._get_cached_url(state, key) is None:
+                missing.append((key, (item, filepath)))
+        if not missing:
+            return
+        urls = self.convert_items_to_flask_urls(
+            ctx, [item for _, item in missing])
+        for (key, _), url in zip(missing, urls):
+            self._set_cached_url(state, key, url, cache_size)
+
+
+class ContentHashUpdater(BaseUpdater):
+    """Rebuilds a bundle only if its inputs have changed: the contents of
+    its source files and dependencies, the bundle definition, and the
+    options of its filters, including the context of a
+    :class:`Jinja2Filter`.
+
+    The inputs of each bundle are recorded in a graph file, by default
+    ``.webassets-graph.json`` in :attr:`Environment.directory`. As long as
+    this file and the outputs are kept, bundles are not rebuilt, even in a
+    fresh checkout where all timestamps are new.
+
+    Enable it with ``ASSETS_UPDATER = 'content'``, or
+    ``'content:/path/to/graph.json'`` to use a different graph file.
+    """
+
+    id = 'content'
+    default_filename = '.webassets-graph.json'
+
+    # webassets creates a new updater instance whenever the option is
+    # accessed, so the loaded graphs and file hashes are shared.
+    _lock = threading.RLock()
+    _graphs = {}
+    _digests = {}
+
+    def __init__(self, filename=None):
+        self.filename = filename
+
+    def get_graph_filename(self, ctx):
+        return path.abspath(self.filename or path.join(
+            ctx.directory, self.default_filename))
+
+    def _load_graph(self, filename):
+        try:
+            mtime = os.stat(filename).st_mtime_ns
+        except OSError:
+            return {}
+        cached = self._graphs.get(filename)
+        if cached is not None and cached[0] == mtime:
+            return cached[1]
+        with open(filename, 'r') as f:
             try:
-                from flask_azure_storage import url_for
-            except ImportError as e:
-                print("You must have Flask Azure Storage to use FLASK_ASSETS_USE_AZURE option")
-                raise e
-        else:
-            from flask import url_for
+                graph = json.load(f)
+            except ValueError:
+                graph = {}
+        self._graphs[filename] = (mtime, graph)
+        return graph
+
+    def _save_graph(self, filename, graph):
+        temp = '%s.%s.tmp' % (filename, os.getpid())
+        with open(temp, 'w') as f:
+            json.dump(graph, f, indent=0, sort_keys=True)
+        os.replace(temp, filename)
+        self._graphs[filename] = (os.stat(filename).st_mtime_ns, graph)
+
+    @classmethod
+    def hash_file(cls, filename):
+        """Return the hash of the contents of ``filename``; it is only
+        computed again if the size or modification time changed.
+        """
+        stat = os.stat(filename)
+        cached = cls._digests.get(filename)
+        if cached is not None and cached[:2] == (stat.st_mtime_ns,
+                                                 stat.st_size):
+            return cached[2]
+        hasher = hashlib.sha1()
+        with open(filename, 'rb') as f:
+            for chunk in iter(lambda: f.read(65536), b''):
+                hasher.update(chunk)
+        digest = hasher.hexdigest()
+        cls._digests[filename] = (stat.st_mtime_ns, stat.st_size, digest)
+        return digest
+
+    def get_filter_options(self, bundle, ctx):
+        """Return the options of all filters used by ``bundle`` and its
+        children, including values taken from the configuration. Values
+        that are not JSON serializable are compared by their ``repr()``.
+        """
+        options = []
+        bundles = [bundle]
+        while bundles:
+            current = bundles.pop(0)
+            for filter in current.filters:
+                values = {}
+                for attribute, (_, configvar, _) in filter._options.items():
+                    value = getattr(filter, attribute, None)
+                    if value is None and configvar:
+                        value = ctx.environment.config.get(
+                            configvar, os.environ.get(configvar))
+                    values[attribute] = value
+                if isinstance(filter, Jinja2Filter):
+                    values['context'] = filter.context
+                options.append([filter.name, values])
+            bundles.extend(
+                c for c in current.contents if isinstance(c, BaseBundle))
+        return json.loads(json.dumps(options, sort_keys=True, default=repr))
+
+    def get_inputs(self, bundle, ctx, filename):
+        """Describe the inputs of ``bundle``, as recorded in the graph
+        file ``filename``. Raises ``OSError`` if a source is missing.
+        """
+        base = path.dirname(filename)
+        sources = {}
+        for source in get_all_bundle_files(bundle, ctx):
+            if is_url(source):
+                continue
+            key = path.relpath(source, base).replace(os.sep, '/')
+            sources[key] = self.hash_file(source)
+        return {
+            'definition': hash_func(bundle),
+            'filters': self.get_filter_options(bundle, ctx),
+            'sources': sources,
+        }
+
+    def needs_rebuild(self, bundle, ctx):
+        filename = self.get_graph_filename(ctx)
+        with self._lock:
+            recorded = self._load_graph(filename).get(bundle.output)
+        if recorded is None:
+            return True
+        try:
+            inputs = self.get_inputs(bundle, ctx, filename)
+        except (OSError, ValueError):
+            return True
+        if inputs['filters'] != recorded.get('filters'):
+            # Not all filter options are part of the cache key.
+            return SKIP_CACHE
+        return inputs != recorded
+
+    def build_done(self, bundle, ctx):
+        # Make sure globs in the dependencies are resolved anew.
+        bundle._resolved_depends = None
+        filename = self.get_graph_filename(ctx)
+        try:
+            inputs = self.get_inputs(bundle, ctx, filename)
+        except (OSError, ValueError):
+            return
+        with self._lock:
+            graph = dict(self._load_graph(filename))
+            graph[bundle.output] = inputs
+            self._save_graph(filename, graph)
+
+
+class _MemoryOutput(object):
+    """An output in a :class:`MemoryStore`."""
+
+    def __init__(self, name, data, version, sri, mtime, immutable):
+        self.name = name
+        self.data = data
+        self.size = len(data)
+        self.etag = hashlib.sha1(data).hexdigest()
+        self.version = version
+        self.sri = sri
+        self.mtime = mtime
+        self.immutable = immutable
+        self.last_modified = time.time()
+
+    def iter_chunks(self, size=64 * 1024):
+        for start in range(0, self.size, size):
+            yield self.data[start:start + size]
+
+
+class MemoryStore(object):
+    """Keeps the outputs of the bundles of an app in ``ASSETS_IN_MEMORY``
+    mode, see :meth:`Environment.build_in_memory`.
+
+    Outputs larger than ``spill_size`` bytes are written to an anonymous
+    temporary file and memory mapped, so that the operating system can
+    page them out.
+    """
 
-        directory, rel_path, endpoint = self.split_prefix(ctx, item)
+    def __init__(self, spill_size=None):
+        self.spill_size = spill_size
+        self._lock = threading.Lock()
+        # Output target of a bundle => its current output.
+        self._outputs = {}
+        # Output filename (with the version) => output.
+        self._names = {}
 
-        if filepath is not None:
-            filename = filepath[len(directory)+1:]
+    def __len__(self):
+        return len(self._names)
+
+    def get(self, name):
+        """Return the output with the filename ``name``, or ``None``."""
+        return self._names.get(name)
+
+    def get_output(self, target):
+        """Return the current output of the bundle with the output
+        target ``target``, or ``None``.
+        """
+        return self._outputs.get(target)
+
+    def _spill(self, data):
+        with tempfile.TemporaryFile() as f:
+            f.write(data)
+            f.flush()
+            # The mapping stays valid after the file has been closed.
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def put(self, target, name, data, version=None, sri=None, mtime=None):
+        """Store ``data`` as the output of the bundle with the output
+        target ``target``, replacing its previous output, and return it.
+        """
+        if self.spill_size is not None and len(data) > self.spill_size:
+            stored = self._spill(data)
         else:
-            filename = rel_path
+            stored = data
+        output = _MemoryOutput(name, stored, version, sri, mtime,
+                               immutable=has_placeholder(target))
+        with self._lock:
+            previous = self._outputs.get(target)
+            if previous is not None:
+                self._names.pop(previous.name, None)
+            self._outputs[target] = output
+            self._names[name] = output
+        return output
+
+    def clear(self):
+        with self._lock:
+            self._outputs.clear()
+            self._names.clear()
+
+
+# The builds in progress in the current thread.
+_builds = threading.local()
+
+class _AtomicHunk(object):
+    """Wraps a hunk, to save it to a temporary file which is then renamed,
+    so that no one ever reads a partially written output.
+    """
 
-        # Windows compatibility
-        filename = filename.replace("\\", "/")
+    def __init__(self, hunk):
+        self._hunk = hunk
 
-        flask_ctx = None
-        if not has_request_context():
-            flask_ctx = ctx.environment._app.test_request_context()
-            flask_ctx.push()
+    def __getattr__(self, name):
+        return getattr(self._hunk, name)
+
+    def __eq__(self, other):
+        return self._hunk == getattr(other, '_hunk', other)
+
+    def __hash__(self):
+        return hash(self._hunk)
+
+    def save(self, filename):
+        temp = '%s.%d-%d.tmp' % (filename, os.getpid(), threading.get_ident())
         try:
-            url = url_for(endpoint, filename=filename)
-            # In some cases, url will be an absolute url with a scheme and hostname.
-            # (for example, when using werkzeug's host matching).
-            # In general, url_for() will return a http url. During assets build, we
-            # we don't know yet if the assets will be served over http, https or both.
-            # Let's use // instead. url_for takes a _scheme argument, but only together
-            # with external=True, which we do not want to force every time. Further,
-            # this _scheme argument is not able to render // - it always forces a colon.
-            if url and url.startswith('http:'):
-                url = url[5:]
-            return url
+            self._hunk.save(temp)
+            os.replace(temp, filename)
+        except BaseException:
+            if path.exists(temp):
+                os.remove(temp)
+            raise
+
+
+class Bundle(BaseBundle):
+    """A webassets bundle which reports its builds to its environment,
+    see :meth:`Environment.get_stats` and the ``bundle_build_started``
+    and ``bundle_build_finished`` signals.
+
+    Builds of bundles with the same output are serialized, so that
+    concurrent requests do not build a bundle more than once: all but the
+    first one find the output to be up to date. With
+    ``ASSETS_BUILD_FILE_LOCK``, a lock file next to the output does the
+    same for multiple processes. Outputs are written to a temporary file
+    first, and then renamed.
+    """
+
+    def resolve_contents(self, ctx=None, force=False):
+        resolved = force or getattr(self, '_resolved_contents', None) is None
+        contents = BaseBundle.resolve_contents(self, ctx, force)
+        env = ctx.environment if ctx is not None else self.env
+        if resolved and isinstance(env, Environment):
+            env._record_files_resolved(self, sum(
+                1 for _, cnt in contents
+                if not isinstance(cnt, BaseBundle) and not is_url(cnt)))
+        return contents
+
+    def _build(self, ctx, extra_filters=None, force=None, output=None,
+               disable_cache=None):
+        env = ctx.environment
+        if not isinstance(env, Environment) or not self.output:
+            return BaseBundle._build(self, ctx, extra_filters, force, output,
+                                     disable_cache)
+
+        filename = ctx.resolver.resolve_output_to_path(ctx, self.output, self)
+        with env._get_build_lock(filename):
+            # Outputs written to a stream do not need the file lock.
+            if output is None and ctx.config.get('build_file_lock'):
+                with self._file_lock(filename):
+                    return self._build_locked(
+                        ctx, env, extra_filters, force, output, disable_cache)
+            return self._build_locked(
+                ctx, env, extra_filters, force, output, disable_cache)
+
+    @contextmanager
+    def _file_lock(self, filename):
+        if fcntl is None:
+            raise EnvironmentError(
+                'ASSETS_BUILD_FILE_LOCK is not supported on this platform')
+        directory = path.dirname(filename)
+        if not path.exists(directory):
+            os.makedirs(directory, exist_ok=True)
+        name = path.basename(filename).replace('%(version)s', '_')
+        with open(path.join(directory, '.%s.lock' % name), 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _build_locked(self, ctx, env, *args):
+        stack = _builds.__dict__.setdefault('stack', [])
+        build = [self, None]
+        stack.append(build)
+        hunk = None
+        try:
+            hunk = BaseBundle._build(self, ctx, *args)
+        except Exception as e:
+            if build[1] is not None:
+                env._record_build(self, ctx, build[1], None, e)
+            raise
         finally:
-            if flask_ctx:
-                flask_ctx.pop()
+            stack.pop()
+        # Only if the bundle was actually built, rather than found to be
+        # up to date, has the build been started.
+        if build[1] is not None:
+            env._record_build(self, ctx, build[1], hunk)
+        return hunk
+
+    def _merge_and_apply(self, ctx, *args, **kwargs):
+        stack = getattr(_builds, 'stack', None)
+        if not stack or stack[-1][0] is not self or stack[-1][1] is not None:
+            return BaseBundle._merge_and_apply(self, ctx, *args, **kwargs)
+
+        stack[-1][1] = time.perf_counter()
+        bundle_build_started.send(ctx.environment, bundle=self)
+        hunk = BaseBundle._merge_and_apply(self, ctx, *args, **kwargs)
+        return _AtomicHunk(hunk) if hunk is not None else None
+
+
+class FlaskAssetsExtension(AssetsExtension):
+    """The webassets Jinja2 extension, extended to render ``{% assets %}``
+    tags that only reference registered bundles from the url manifest of
+    the current app, if one has been loaded (see
+    :meth:`Environment.load_url_manifest`).
+
+    In debug mode, the urls of all source files of a bundle are generated
+    at once, see :meth:`FlaskResolver.prefetch_urls`.
+    """
+
+    BundleClass = Bundle
+
+    def _render_assets(self, filter, output, dbg, depends, files, caller=None):
+        env = self.environment.assets_environment
+        if env is not None and filter is None and output is None and \
+                dbg is None and depends is None:
+            urls = env._query_url_manifest(files)
+            if urls is not None:
+                # This is what the extra values of a bundle wrapping
+                # the referenced bundles would be.
+                extra = {}
+                for name in files:
+                    extra.update(env[name].extra or {})
+                urls = [{'uri': url, 'sri': sri} for url, sri in urls]
+                if self.environment.is_async:
+                    return self._render_urls_async(urls, extra, caller)
+                return self._render_urls(urls, extra, caller)
+        if env is None:
+            raise RuntimeError('No assets environment configured in '+
+                               'Jinja2 environment')
+
+        # Construct a bundle with the given options
+        bundle_kwargs = {
+            'output': output,
+            'filters': filter,
+            'debug': dbg,
+            'depends': depends
+        }
+        bundle = self.BundleClass(
+            *self.resolve_contents(files, env), **bundle_kwargs)
+
+        # Retrieve urls (this may or may not cause a build). With an async
+        # Jinja2 environment, this is done in the background.
+        if self.environment.is_async:
+            return self._render_urls_async(
+                env.urls_async(bundle), bundle.extra, caller)
+        return self._render_urls(env.urls(bundle), bundle.extra, caller)
+
+    def _render_urls(self, urls, extra, caller):
+        # For each url, execute the content of this template tag (represented
+        # by the macro ```caller`` given to use by Jinja2).
+        result = u""
+        for entry in urls:
+            if isinstance(entry, dict):
+                result += caller(entry['uri'], entry.get('sri', None), extra)
+            else:
+                result += caller(entry, None, extra)
+        return result
+
+    async def _render_urls_async(self, urls, extra, caller):
+        if not isinstance(urls, list):
+            urls = await urls
+        # The macro is a coroutine function in an async environment.
+        result = u""
+        for entry in urls:
+            if isinstance(entry, dict):
+                result += await caller(entry['uri'], entry.get('sri', None),
+                                       extra)
+            else:
+                result += await caller(entry, None, extra)
+        return result
+
+
+class _AppState(object):
+    """The state an :class:`Environment` keeps for each app it is used
+    with, in a registry with weak references to the apps, so that it is
+    collected along with the app. Everything is created when it is first
+    needed.
+    """
+
+    __slots__ = (
+        # FlaskConfigStorage: values of keys not in the app config.
+        'config',
+        # FlaskResolver: memoized urls, url backend, and the blueprint
+        # index as a (number of blueprints, index) 2-tuple.
+        'url_cache', 'url_backend', 'blueprint_index',
+        # The loaded url manifest, the patterns of versioned outputs.
+        'url_manifest', 'hashed_output_patterns',
+        # Building: the in-memory outputs, the prewarming thread, and the
+        # locks for each output path.
+        'memory_store', 'prewarmer', 'build_locks',
+        # The calls running in the background for urls_async() and
+        # build_async(), as concurrent futures.
+        'async_calls',
+    )
+
+    def __init__(self):
+        for name in self.__slots__:
+            setattr(self, name, None)
+
+
+class _Prewarmer(object):
+    """Generates the urls of the bundles of an environment for an app in a
+    background thread, building them if necessary, see
+    :meth:`Environment.init_app`.
+    """
+
+    def __init__(self, env, app):
+        self.env = env
+        self.app = app
+        self.thread = None
+        self._lock = threading.Lock()
+        self._queue = []
+        self._pending = {}
+        self._seen = weakref.WeakSet()
+
+    def add(self, bundles):
+        """Queue those of ``bundles`` which were not queued before, and
+        start the thread if it is not running.
+        """
+        with self._lock:
+            for bundle in bundles:
+                if bundle in self._seen:
+                    continue
+                self._seen.add(bundle)
+                self._queue.append(bundle)
+                self._pending[bundle] = threading.Event()
+            if self._queue and (self.thread is None or
+                                not self.thread.is_alive()):
+                self.thread = threading.Thread(
+                    target=self._run, name='flask-assets-prewarm')
+                self.thread.daemon = True
+                self.thread.start()
+
+    def wait(self, bundle):
+        """Wait until ``bundle`` has been processed, if it is queued."""
+        event = self._pending.get(bundle)
+        if event is not None and threading.current_thread() is not self.thread:
+            event.wait()
+
+    def _next(self):
+        with self._lock:
+            if not self._queue:
+                # Unless there is more work, the thread is done.
+                self.thread = None
+                return None
+            return self._queue.pop(0)
+
+    def _run(self):
+        with self.app.app_context(), self.env.build_context():
+            while True:
+                bundle = self._next()
+                if bundle is None:
+                    return
+                try:
+                    if self.app.config.get('ASSETS_IN_MEMORY'):
+                        self.env.in_memory_urls(bundle)
+                    else:
+                        with bundle.bind(self.env):
+                            bundle.urls()
+                except Exception:
+                    # The request needing the bundle will fail in turn.
+                    self.app.logger.exception(
+                        'Failed to prewarm bundle %s', bundle)
+                finally:
+                    self._pending.pop(bundle).set()
+
+    def join(self, timeout=None):
+        thread = self.thread
+        if thread is not None:
+            thread.join(timeout)
+
+
+class _YAMLBundleLoader(YAMLLoader):
+    """Creates the bundles defined in a YAML file one by one, as instances
+    of :class:`Bundle`.
+
+    The parsed file is cached in a JSON file, which is used as long as the
+    modification time and size, or else the hash of the YAML file do not
+    change.
+    """
+
+    def __init__(self, filename, cache_filename=None):
+        YAMLLoader.__init__(self, filename)
+        if cache_filename is None:
+            directory, name = path.split(path.abspath(filename))
+            cache_filename = path.join(directory, '.%s.cache.json' % name)
+        self.cache_filename = cache_filename
+
+    def _get_bundle(self, data):
+        kwargs = dict(
+            filters=data.get('filters', None),
+            output=data.get('output', None),
+            debug=data.get('debug', None),
+            extra=data.get('extra', {}),
+            config=data.get('config', {}),
+            depends=data.get('depends', None))
+        return Bundle(*list(self._yield_bundle_contents(data)), **kwargs)
+
+    def load_data(self):
+        """Return the parsed YAML file."""
+        st = os.stat(self.file_or_filename)
+        signature = [st.st_mtime_ns, st.st_size]
+        cached = None
+        if self.cache_filename:
+            try:
+                with open(self.cache_filename) as f:
+                    cached = json.load(f)
+            except (IOError, ValueError):
+                pass
+        if cached and cached.get('signature') == signature:
+            return cached['data']
+
+        with open(self.file_or_filename, 'rb') as f:
+            source = f.read()
+        digest = hashlib.sha1(source).hexdigest()
+        if cached and cached.get('sha1') == digest:
+            data = cached['data']
+        else:
+            data = self.yaml.safe_load(source) or {}
+
+        if self.cache_filename:
+            temp = '%s.%d.tmp' % (self.cache_filename, os.getpid())
+            try:
+                with open(temp, 'w') as f:
+                    json.dump({'signature': signature, 'sha1': digest,
+                               'data': data}, f)
+                os.replace(temp, self.cache_filename)
+            except (IOError, TypeError, ValueError):
+                # The cache is optional, e.g. the directory is read-only.
+                if path.exists(temp):
+                    os.remove(temp)
+        return data
+
+
+def _index_module_bundles(module_name):
+    """Return the names assigned a ``Bundle(...)`` call at the top level
+    of the source of a module, without importing it, or ``None`` if the
+    source is not available.
+    """
+    try:
+        spec = find_spec(module_name)
+    except (ImportError, ValueError):
+        return None
+    if spec is None or not spec.origin or not spec.origin.endswith('.py'):
+        return None
+    with open(spec.origin, 'rb') as f:
+        tree = ast.parse(f.read(), spec.origin)
+
+    names = []
+    for node in tree.body:
+        if not isinstance(node, ast.Assign) or \
+                not isinstance(node.value, ast.Call):
+            continue
+        func = node.value.func
+        func_name = getattr(func, 'id', None) or getattr(func, 'attr', '')
+        if not func_name.endswith('Bundle'):
+            continue
+        names.extend(target.id for target in node.targets
+                     if isinstance(target, ast.Name))
+    return names
 
 
 class Environment(BaseEnvironment):
@@ -311,7 +1395,21 @@ class Environment(BaseEnvironment):
 
     def __init__(self, app=None):
         self.app = app
+        self._app_states = weakref.WeakKeyDictionary()
+        self._app_states_lock = threading.Lock()
+        self._prewarming = False
+        self._has_url_manifests = False
+        self._async_executor = None
+        # Name => function registering the bundle, see from_yaml().
+        self._lazy_bundles = OrderedDict()
+        # Modules registered with from_module(lazy=True), not loaded yet.
+        self._lazy_modules = []
+        self._lazy_lock = threading.RLock()
+        self._stats_lock = threading.Lock()
+        self._bundle_stats = weakref.WeakKeyDictionary()
+        self._url_stats = dict.fromkeys(self.url_stats_keys, 0)
         super(Environment, self).__init__()
+        self.config.setdefault('url_cache_size', 1024)
         if app:
             self.init_app(app)
 
@@ -323,10 +1421,15 @@ class Environment(BaseEnvironment):
         if self.app is not None:
             return self.app
 
-        if has_request_context():
+        if _cv_app is not None:
+            # A request context always comes with an app context for the
+            # same app, so this is the only lookup we need to do.
+            ctx = _cv_app.get(None)
+            if ctx is not None:
+                return ctx.app
+        elif has_request_context():
             return request_ctx.app
-
-        if has_app_context():
+        elif has_app_context():
             return app_ctx.app
 
         raise RuntimeError('assets instance not bound to an application, '+
@@ -357,21 +1460,849 @@ class Environment(BaseEnvironment):
     url = property(get_url, set_url, doc=
     """The base url to which all static urls will be relative to.""")
 
-    def init_app(self, app):
-        app.jinja_env.add_extension('webassets.ext.jinja2.AssetsExtension')
+    @contextmanager
+    def build_context(self):
+        """Context manager which pushes a single request context for the
+        current app, unless there already is one.
+
+        Outside of a request, a request context is needed to generate
+        urls; without this, one is created for every single url. Use it
+        around builds, or when rendering many bundles outside a request:
+
+        .. code-block:: python
+
+            with assets.build_context():
+                for bundle in assets:
+                    bundle.build()
+        """
+        if has_request_context():
+            yield
+            return
+        ctx = self._app.test_request_context()
+        ctx.push()
+        try:
+            yield
+        finally:
+            ctx.pop()
+
+    def clear_url_cache(self, app=None):
+        """Invalidate the urls memoized by the resolver, for ``app`` or
+        for all applications. This is done automatically after bundles
+        have been built through the command line interface.
+        """
+        resolver = self.resolver
+        if isinstance(resolver, FlaskResolver):
+            resolver.clear_url_cache(self, app)
+
+    def _get_app_state(self, app):
+        """Return the :class:`_AppState` of ``app``, which is collected
+        along with the app.
+        """
+        try:
+            return self._app_states[app]
+        except KeyError:
+            with self._app_states_lock:
+                return self._app_states.setdefault(app, _AppState())
+
+    def _get_build_lock(self, filename):
+        state = self._get_app_state(self._app)
+        with self._app_states_lock:
+            if state.build_locks is None:
+                state.build_locks = {}
+            return state.build_locks.setdefault(filename, threading.RLock())
+
+    def init_app(self, app, prewarm=None):
+        """Initialize the environment for ``app``.
+
+        With ``prewarm`` (by default, ``ASSETS_PREWARM``), the urls of all
+        bundles, including those registered later on, are generated in a
+        background thread, so that the bundles are built (and the urls
+        cached) before they are first needed. Requests rendering a bundle
+        before this is done wait for it, instead of building it again.
+        """
+        app.jinja_env.add_extension(FlaskAssetsExtension)
         app.jinja_env.assets_environment = self
+        with app.app_context():
+            resolver = self.resolver
+        if isinstance(resolver, FlaskResolver):
+            resolver.get_url_backend(self, app)
+        if app.config.get('ASSETS_URL_MANIFEST'):
+            self.load_url_manifest(app)
+        if app.config.get('ASSETS_HASH_OUTPUTS'):
+            self._add_version_placeholders()
+        app.after_request(self._add_immutable_headers)
+        if app.config.get('ASSETS_SERVE_PRECOMPRESSED'):
+            app.before_request(self._serve_precompressed)
+        if app.config.get('ASSETS_IN_MEMORY'):
+            blueprint = Blueprint(
+                self.in_memory_endpoint.split('.')[0], __name__,
+                url_prefix=app.config.get('ASSETS_IN_MEMORY_URL', '/_assets'))
+            blueprint.add_url_rule('/<path:filename>', 'output',
+                                   self._serve_in_memory)
+            app.register_blueprint(blueprint)
+        if prewarm is None:
+            prewarm = app.config.get('ASSETS_PREWARM')
+        if prewarm:
+            self._get_app_state(app).prewarmer = _Prewarmer(self, app)
+            self._prewarming = True
+            self._prewarm()
+
+    def _prewarm(self):
+        if not self._prewarming:
+            return
+        bundles = list(self._named_bundles.values()) + self._anon_bundles
+        for state in list(self._app_states.values()):
+            if state.prewarmer is not None:
+                state.prewarmer.add(bundles)
+
+    def urls(self, bundle):
+        """Return the urls of ``bundle`` (or of the bundle registered under
+        that name), like ``bundle.urls(calculate_sri=True)``, as
+        ``{% assets %}`` tags do: waiting for the bundle to be prewarmed,
+        and building it into memory with ``ASSETS_IN_MEMORY``.
+        """
+        if isinstance(bundle, str):
+            bundle = self[bundle]
+
+        # Don't build bundles which are being prewarmed a second time.
+        self.wait_for_prewarm(bundle)
+        for content in bundle.contents:
+            if isinstance(content, BaseBundle):
+                self.wait_for_prewarm(content)
+
+        with bundle.bind(self):
+            ctx = wrap(self, bundle)
+            if ctx.debug is True and isinstance(ctx.resolver, FlaskResolver):
+                # Urls to all source files will be needed.
+                ctx.resolver.prefetch_urls(ctx, bundle)
+            if ctx.config.get('in_memory'):
+                return self.in_memory_urls(bundle)
+            return bundle.urls(calculate_sri=True)
+
+    def _get_async_executor(self):
+        if self._async_executor is None:
+            with self._app_states_lock:
+                if self._async_executor is None:
+                    self._async_executor = ThreadPoolExecutor(
+                        thread_name_prefix='flask-assets')
+        return self._async_executor
+
+    def _set_async_executor(self, executor):
+        self._async_executor = executor
+
+    async_executor = property(_get_async_executor, _set_async_executor, doc=
+    """The executor in which :meth:`urls_async` and :meth:`build_async`
+    do their work; by default, a thread pool of the environment.
+    """)
+
+    def _get_async_key(self, bundle):
+        # The bundles of {% assets %} tags are created for each render, but
+        # are equivalent if their contents and options are.
+        return (tuple(id(c) if isinstance(c, BaseBundle) else c
+                      for c in bundle.contents),
+                bundle.output, repr(bundle.filters), bundle.debug,
+                repr(bundle.depends),
+                request.root_url if has_request_context() else None)
+
+    def _run_shared(self, key, func, *args):
+        """Run ``func`` in the :attr:`async_executor`, in a copy of the
+        current context, unless a call with the same ``key`` is running
+        for the current app already, and return an awaitable of the result.
+        """
+        state = self._get_app_state(self._app)
+        executor = self.async_executor
+        with self._app_states_lock:
+            if state.async_calls is None:
+                state.async_calls = {}
+            future = state.async_calls.get(key)
+            started = future is None
+            if started:
+                future = state.async_calls[key] = executor.submit(
+                    contextvars.copy_context().run, func, *args)
+
+        if started:
+            def done(future):
+                with self._app_states_lock:
+                    if state.async_calls.get(key) is future:
+                        del state.async_calls[key]
+            future.add_done_callback(done)
+        return asyncio.wrap_future(future)
+
+    async def urls_async(self, bundle):
+        """Like :meth:`urls`, but building the bundle, if necessary, in the
+        :attr:`async_executor`, so that the event loop is not blocked.
+        Concurrent calls for the same bundle share a single build.
+        """
+        if isinstance(bundle, str):
+            bundle = self[bundle]
+        return await self._run_shared(
+            ('urls',) + self._get_async_key(bundle), self.urls, bundle)
+
+    async def build_async(self, bundle, force=None):
+        """Build ``bundle`` (or the bundle registered under that name) in
+        the :attr:`async_executor`, like ``bundle.build(force=force)``.
+        Concurrent calls for the same bundle share a single build.
+        """
+        if isinstance(bundle, str):
+            bundle = self[bundle]
+
+        def build():
+            with bundle.bind(self):
+                return bundle.build(force=force)
+        return await self._run_shared(
+            ('build', force) + self._get_async_key(bundle), build)
+
+    def wait_for_prewarm(self, bundle=None, timeout=None):
+        """Wait until ``bundle`` (or all bundles) have been prewarmed for
+        the current app, see :meth:`init_app`.
+        """
+        if not self._prewarming:
+            return
+        prewarmer = self._get_app_state(self._app).prewarmer
+        if prewarmer is None:
+            return
+        if bundle is None:
+            prewarmer.join(timeout)
+        else:
+            prewarmer.wait(bundle)
+
+    # The counters kept for each bundle, and for url generation.
+    bundle_stats_keys = ('builds', 'build_errors', 'build_seconds',
+                         'bytes_in', 'bytes_out', 'files_resolved')
+    url_stats_keys = ('url_cache_hits', 'url_cache_misses', 'urls_resolved',
+                      'url_seconds')
+
+    def _get_bundle_stats(self, bundle):
+        stats = self._bundle_stats.get(bundle)
+        if stats is None:
+            stats = self._bundle_stats[bundle] = dict.fromkeys(
+                self.bundle_stats_keys, 0)
+        return stats
+
+    def _record_build(self, bundle, ctx, start, hunk, exception=None):
+        duration = time.perf_counter() - start
+        bytes_in = 0
+        for filename in get_all_bundle_files(bundle, ctx):
+            try:
+                bytes_in += path.getsize(filename)
+            except OSError:
+                pass
+        bytes_out = len(hunk.data().encode('utf-8')) if hunk else 0
+        with self._stats_lock:
+            stats = self._get_bundle_stats(bundle)
+            stats['builds'] += 1
+            stats['build_errors'] += exception is not None
+            stats['build_seconds'] += duration
+            stats['bytes_in'] += bytes_in
+            stats['bytes_out'] += bytes_out
+        bundle_build_finished.send(
+            self, bundle=bundle, duration=duration, bytes_in=bytes_in,
+            bytes_out=bytes_out, exception=exception)
+
+    def _record_files_resolved(self, bundle, count):
+        with self._stats_lock:
+            self._get_bundle_stats(bundle)['files_resolved'] += count
+
+    def _record_url_lookup(self, item, url):
+        key = 'url_cache_misses' if url is None else 'url_cache_hits'
+        with self._stats_lock:
+            self._url_stats[key] += 1
+        signal = url_cache_missed if url is None else url_cache_hit
+        if signal.receivers:
+            signal.send(self, item=item, url=url)
+
+    def _record_url_resolved(self, item, url, duration):
+        with self._stats_lock:
+            self._url_stats['urls_resolved'] += 1
+            self._url_stats['url_seconds'] += duration
+        if url_resolved.receivers:
+            url_resolved.send(self, item=item, url=url, duration=duration)
+
+    def get_stats(self):
+        """Return the counters recorded since the environment was created,
+        to be exported to a monitoring system::
+
+            {'bundles': {<bundle name>: {'builds': ..., ...}},
+             'urls': {'url_cache_hits': ..., ...}}
+
+        For each bundle, there are the number of ``builds`` and
+        ``build_errors``, the total ``build_seconds``, the sizes of the
+        inputs and outputs of the builds (``bytes_in``, ``bytes_out``),
+        and the number of source files resolved (``files_resolved``).
+        Bundles which are not registered are named by their output.
+
+        Only bundles created with :class:`Bundle` of this module are
+        counted.
+        """
+        names = dict((id(bundle), name)
+                     for name, bundle in self._named_bundles.items())
+        with self._stats_lock:
+            bundles = {}
+            for bundle, stats in self._bundle_stats.items():
+                name = names.get(id(bundle)) or bundle.output or repr(bundle)
+                totals = bundles.setdefault(
+                    name, dict.fromkeys(self.bundle_stats_keys, 0))
+                for key, value in stats.items():
+                    totals[key] += value
+            return {'bundles': bundles, 'urls': dict(self._url_stats)}
+
+    def reset_stats(self):
+        """Reset all counters returned by :meth:`get_stats`."""
+        with self._stats_lock:
+            self._bundle_stats.clear()
+            self._url_stats = dict.fromkeys(self.url_stats_keys, 0)
+
+    # The endpoint serving the outputs kept in memory.
+    in_memory_endpoint = 'flask_assets.output'
+
+    @property
+    def memory_store(self):
+        """The :class:`MemoryStore` of the current app."""
+        app = self._app
+        state = self._get_app_state(app)
+        if state.memory_store is None:
+            with self._app_states_lock:
+                if state.memory_store is None:
+                    state.memory_store = MemoryStore(
+                        app.config.get('ASSETS_IN_MEMORY_SPILL_SIZE'))
+        return state.memory_store
+
+    def build_in_memory(self, bundle, force=None):
+        """Build ``bundle`` into the :attr:`memory_store` of the current
+        app instead of writing its output files, and return the outputs.
+
+        Like with a build from a template, outputs are only rebuilt if
+        their source files changed, unless ``force`` is given; with
+        ``auto_build`` disabled, outputs are only built once.
+        """
+        store = self.memory_store
+        outputs = []
+        with bundle.bind(self):
+            for leaf, extra_filters, ctx in bundle.iterbuild(wrap(self, bundle)):
+                outputs.append(self._build_leaf_in_memory(
+                    store, leaf, extra_filters, ctx, force))
+        return outputs
+
+    def _build_leaf_in_memory(self, store, bundle, extra_filters, ctx, force):
+        if not bundle.output:
+            raise BuildError('No output target found for %s' % bundle)
+
+        output = store.get_output(bundle.output)
+        if output is not None and not force:
+            if not ctx.auto_build:
+                return output
+            mtime = self._get_sources_mtime(bundle, ctx)
+            if mtime <= output.mtime:
+                return output
+        else:
+            mtime = self._get_sources_mtime(bundle, ctx)
+
+        buffer = io.StringIO()
+        bundle._build(ctx, extra_filters=extra_filters, force=True,
+                      output=buffer)
+        text = buffer.getvalue()
+        data = text.encode('utf-8')
+
+        version = None
+        if has_placeholder(bundle.output) or ctx.url_expire != False:
+            if ctx.versions:
+                version = ctx.versions.determine_version(
+                    bundle, ctx, MemoryHunk(text))
+            else:
+                version = hashlib.md5(data).hexdigest()[:8]
+        name = bundle.output
+        if has_placeholder(name):
+            name = name % {'version': version}
+        return store.put(bundle.output, name, data, version=version,
+                         sri=calculate_sri(data), mtime=mtime)
+
+    def _get_sources_mtime(self, bundle, ctx):
+        mtime = 0
+        for filename in get_all_bundle_files(bundle, ctx):
+            try:
+                mtime = max(mtime, path.getmtime(filename))
+            except OSError:
+                pass
+        return mtime
+
+    def in_memory_urls(self, bundle):
+        """Like ``bundle.urls(calculate_sri=True)``, but builds the bundle
+        into the :attr:`memory_store` of the current app; the urls point
+        to the blueprint serving it (``ASSETS_IN_MEMORY_URL``).
+        """
+        with bundle.bind(self):
+            ctx = wrap(self, bundle)
+            if ctx.debug is not False or \
+                    not (bundle.is_container or bundle.output):
+                # The source files are served as they are.
+                return bundle.urls(calculate_sri=True)
+            urls = []
+            for output in self.build_in_memory(bundle):
+                url = ctx.resolver.resolve_output_to_url(ctx, output.name)
+                if ctx.url_expire or (ctx.url_expire is None and
+                                      not output.immutable):
+                    url = '%s?%s' % (url, output.version)
+                urls.append({'uri': url, 'sri': output.sri})
+            return urls
+
+    def _serve_in_memory(self, filename):
+        output = self.memory_store.get(filename)
+        if output is None:
+            abort(404)
+        if isinstance(output.data, bytes):
+            body = output.data
+        else:
+            body = output.iter_chunks()
+        response = current_app.response_class(
+            body, mimetype=mimetypes.guess_type(filename)[0] or
+            'application/octet-stream')
+        response.content_length = output.size
+        response.set_etag(output.etag)
+        response.last_modified = output.last_modified
+        if output.immutable:
+            response.headers['Cache-Control'] = self.immutable_cache_control
+        return response.make_conditional(request)
+
+    # Cache-Control header sent for outputs which have their version in
+    # the filename, by default one year.
+    immutable_cache_control = 'public, max-age=31536000, immutable'
+
+    def register(self, name, *args, **kwargs):
+        if self._lazy_bundles:
+            names = name if isinstance(name, dict) else [name]
+            for key in names:
+                self._lazy_bundles.pop(key, None)
+        result = super(Environment, self).register(name, *args, **kwargs)
+        self._add_version_placeholders()
+        self._prewarm()
+        return result
+    register.__doc__ = BaseEnvironment.register.__doc__
+
+    def add(self, *bundles):
+        super(Environment, self).add(*bundles)
+        self._add_version_placeholders()
+        self._prewarm()
+    add.__doc__ = BaseEnvironment.add.__doc__
+
+    def _add_version_placeholders(self):
+        """With ``ASSETS_HASH_OUTPUTS`` enabled, insert a version
+        placeholder before the extension of each output filename that
+        does not contain one, e.g. ``gen/packed.%(version)s.js``.
+
+        If no app is available, this is done once ``init_app`` is called.
+        """
+        try:
+            if not self.config.get('hash_outputs'):
+                return
+        except RuntimeError:
+            return
+        bundles = list(self)
+        while bundles:
+            bundle = bundles.pop()
+            if bundle.output and not has_placeholder(bundle.output):
+                root, ext = path.splitext(bundle.output)
+                bundle.output = '%s.%%(version)s%s' % (root, ext)
+            bundles.extend(c for c in bundle.contents if isinstance(c, BaseBundle))
+
+    def _get_precompress_encodings(self):
+        encodings = self.config.get('precompress')
+        if not encodings:
+            return []
+        if encodings is True:
+            return [e for e, (_, compress) in precompress_encodings.items()
+                    if compress]
+        if isinstance(encodings, str):
+            encodings = [e.strip() for e in encodings.split(',')]
+        for encoding in encodings:
+            if encoding not in precompress_encodings:
+                raise EnvironmentError(
+                    'Unknown precompress encoding: %s' % encoding)
+            if not precompress_encodings[encoding][1]:
+                raise EnvironmentError(
+                    'The "%s" encoding requires the brotli package' % encoding)
+        return list(encodings)
+
+    def precompress_outputs(self, bundles=None, jobs=None):
+        """Write compressed variants of the output files of ``bundles``
+        (by default, all bundles) next to them, for the encodings given
+        by ``ASSETS_PRECOMPRESS``: a list like ``['br', 'gzip']``, or
+        ``True`` for all available ones. Brotli requires the ``brotli``
+        package.
+
+        The files are compressed in parallel, using up to ``jobs``
+        threads. This is done automatically by ``flask assets build``.
+        """
+        encodings = self._get_precompress_encodings()
+        if not encodings:
+            return
+
+        filenames = set()
+        for bundle in (self if bundles is None else bundles):
+            with bundle.bind(self):
+                for leaf, _, ctx in bundle.iterbuild(wrap(self, bundle)):
+                    if not leaf.output:
+                        continue
+                    try:
+                        filename = leaf.resolve_output(ctx)
+                    except BundleError:
+                        continue
+                    if path.isfile(filename):
+                        filenames.add(filename)
+
+        def compress(filename):
+            with open(filename, 'rb') as f:
+                data = f.read()
+            for encoding in encodings:
+                extension, compress = precompress_encodings[encoding]
+                temp = '%s%s.%s.tmp' % (filename, extension, os.getpid())
+                with open(temp, 'wb') as f:
+                    f.write(compress(data))
+                os.replace(temp, filename + extension)
+
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            list(executor.map(compress, sorted(filenames)))
+
+    def _serve_precompressed(self):
+        """``before_request`` handler which serves a precompressed variant
+        of a static file, if there is one the client accepts.
+        """
+        endpoint = request.endpoint
+        if not endpoint or not request.view_args or \
+                not (endpoint == 'static' or endpoint.endswith('.static')):
+            return None
+        filename = request.view_args.get('filename')
+        app = self._app
+        if endpoint == 'static':
+            scaffold = app
+        else:
+            scaffold = app.blueprints.get(endpoint[:-len('.static')])
+        folder = getattr(scaffold, 'static_folder', None)
+        if not filename or not folder:
+            return None
+
+        for encoding, (extension, _) in precompress_encodings.items():
+            if not request.accept_encodings[encoding]:
+                continue
+            compressed = safe_join(folder, filename + extension)
+            if compressed is None or not path.isfile(compressed):
+                continue
+            mimetype = mimetypes.guess_type(filename)[0]
+            response = send_from_directory(
+                folder, filename + extension,
+                mimetype=mimetype or 'application/octet-stream')
+            response.headers['Content-Encoding'] = encoding
+            response.vary.add('Accept-Encoding')
+            return response
+        return None
+
+    def _get_hashed_output_patterns(self, app):
+        """Return a dict mapping static endpoints to regular expressions
+        matching the filenames of outputs with a version placeholder.
+        """
+        # Bundles which are loaded lazily are only considered once loaded.
+        key = (len(self._named_bundles) + len(self._anon_bundles),
+               len(getattr(app, 'blueprints', ())))
+        state = self._get_app_state(app)
+        cached = state.hashed_output_patterns
+        if cached is not None and cached[0] == key:
+            return cached[1]
+
+        patterns = {}
+        resolver = self.resolver
+        if isinstance(resolver, FlaskResolver) and \
+                not resolver.use_webassets_system_for_output(self):
+            bundles = list(self._named_bundles.values()) + self._anon_bundles
+            while bundles:
+                bundle = bundles.pop()
+                bundles.extend(
+                    c for c in bundle.contents if isinstance(c, BaseBundle))
+                if not bundle.output or not has_placeholder(bundle.output):
+                    continue
+                _, rel_path, endpoint = resolver.split_prefix(
+                    self, bundle.output)
+                patterns.setdefault(endpoint, []).append('[^/]+'.join(
+                    re.escape(part) for part in rel_path.split('%(version)s')))
+        patterns = dict((endpoint, re.compile('^(%s)$' % '|'.join(p)))
+                        for endpoint, p in patterns.items())
+        state.hashed_output_patterns = (key, patterns)
+        return patterns
+
+    def _add_immutable_headers(self, response):
+        """``after_request`` handler which allows browsers to cache the
+        outputs that have their version in the filename forever.
+        """
+        if response.status_code != 200 or not request.view_args:
+            return response
+        filename = request.view_args.get('filename')
+        pattern = self._get_hashed_output_patterns(self._app).get(
+            request.endpoint)
+        if pattern is not None and filename and pattern.match(filename):
+            response.headers['Cache-Control'] = self.immutable_cache_control
+        return response
+
+    def _get_url_manifest_path(self, app):
+        filename = app.config.get('ASSETS_URL_MANIFEST')
+        if not filename:
+            return None
+        return path.join(app.root_path, filename)
+
+    def write_url_manifest(self):
+        """Write the final urls (including versions) of all named bundles
+        to the file configured as ``ASSETS_URL_MANIFEST`` of the current
+        app, and use them from now on.
+
+        This is done automatically by ``flask assets build``.
+        """
+        app = self._app
+        filename = self._get_url_manifest_path(app)
+        if not filename:
+            raise RuntimeError('ASSETS_URL_MANIFEST is not configured')
+
+        manifest = {}
+        self.load_lazy_bundles()
+        with self.build_context():
+            for name, bundle in self._named_bundles.items():
+                with bundle.bind(self):
+                    urls = bundle.urls(calculate_sri=True)
+                manifest[name] = [(entry['uri'], entry.get('sri'))
+                                  for entry in urls]
+        with open(filename, 'w') as f:
+            json.dump(manifest, f, indent=0, sort_keys=True)
+        self._get_app_state(app).url_manifest = manifest
+        self._has_url_manifests = True
+
+    def load_url_manifest(self, app=None):
+        """Load the url manifest of ``app`` (or the current app), if it
+        has been written. From then on, ``{% assets %}`` tags referencing
+        only registered bundles emit the precomputed urls, without
+        touching the filesystem or the resolver.
+
+        Returns ``False`` if there is no manifest file.
+        """
+        app = app or self._app
+        filename = self._get_url_manifest_path(app)
+        if not filename or not path.exists(filename):
+            self._get_app_state(app).url_manifest = None
+            return False
+        with open(filename, 'r') as f:
+            self._get_app_state(app).url_manifest = json.load(f)
+        self._has_url_manifests = True
+        return True
+
+    def _query_url_manifest(self, names):
+        """Return the precomputed urls of the given bundles, as a list of
+        (url, sri) 2-tuples, or ``None`` if they are not all known.
+        """
+        if not self._has_url_manifests:
+            return None
+        manifest = self._get_app_state(self._app).url_manifest
+        if not manifest:
+            return None
+        result = []
+        for name in names:
+            if not isinstance(name, str) or name not in manifest:
+                return None
+            result.extend(manifest[name])
+        return result
+
+    def from_yaml(self, path, lazy=False, cache=None):
+        """Register bundles from a YAML configuration file.
+
+        With ``lazy``, only the names of the bundles are registered, and
+        each bundle is created when it is first accessed. The parsed file
+        is then cached in ``cache`` (by default, a ``.<filename>.cache.json``
+        file next to it; pass ``False`` to disable it), so that it is only
+        parsed again once it changes.
+        """
+        if not lazy:
+            bundles = YAMLLoader(path).load_bundles()
+            for name in bundles:
+                self.register(name, bundles[name])
+            return
+
+        loader = _YAMLBundleLoader(path, cache)
+        data = loader.load_data()
+        with self._lazy_lock:
+            for name in data:
+                if name not in self._named_bundles:
+                    self._lazy_bundles[name] = partial(
+                        self._load_yaml_bundle, loader, data)
+
+    def _load_yaml_bundle(self, loader, data, name):
+        bundle = loader._get_bundle(data[name] or {})
+        # Like YAMLLoader, resolve references to other bundles.
+        contents = tuple(
+            self[item] if isinstance(item, str) and item in self else item
+            for item in bundle.contents)
+        if contents != bundle.contents:
+            bundle.contents = contents
+        self.register(name, bundle)
+
+    def from_module(self, path, lazy=False):
+        """Register bundles from a Python module.
+
+        With ``lazy``, the module is only imported once one of its bundles
+        is accessed. Its bundles are found by looking for names assigned
+        a ``Bundle(...)`` at the top level of its source.
+        """
+        names = _index_module_bundles(path) \
+            if lazy and isinstance(path, str) and ':' not in path else None
+        if names is None:
+            bundles = PythonLoader(path).load_bundles()
+            for name in bundles:
+                self.register(name, bundles[name])
+            return
+
+        load = partial(self._load_module_bundles, path)
+        with self._lazy_lock:
+            self._lazy_modules.append(path)
+            for name in names:
+                if name not in self._named_bundles:
+                    self._lazy_bundles[name] = load
+
+    def _load_module_bundles(self, module_name, name=None):
+        with self._lazy_lock:
+            if module_name not in self._lazy_modules:
+                return
+            self._lazy_modules.remove(module_name)
+            bundles = PythonLoader(module_name).load_bundles()
+            for bundle_name in bundles:
+                self._lazy_bundles.pop(bundle_name, None)
+                if bundle_name not in self._named_bundles:
+                    self.register(bundle_name, bundles[bundle_name])
+
+    def _load_lazy_bundle(self, name):
+        """Create the bundle ``name`` if it is loaded lazily, and return
+        whether it is registered now.
+        """
+        with self._lazy_lock:
+            load = self._lazy_bundles.get(name)
+            if load is not None:
+                load(name)
+                self._lazy_bundles.pop(name, None)
+            elif self._lazy_modules and name not in self._named_bundles:
+                # The module may define the bundle in an unexpected way.
+                for module_name in list(self._lazy_modules):
+                    self._load_module_bundles(module_name)
+            return name in self._named_bundles
+
+    def load_lazy_bundles(self):
+        """Create all bundles which are loaded lazily, see
+        :meth:`from_yaml` and :meth:`from_module`.
+        """
+        with self._lazy_lock:
+            for name in list(self._lazy_bundles):
+                self._load_lazy_bundle(name)
+            for module_name in list(self._lazy_modules):
+                self._load_module_bundles(module_name)
+
+    def __getitem__(self, name):
+        try:
+            return self._named_bundles[name]
+        except KeyError:
+            if not (self._lazy_bundles or self._lazy_modules) or \
+                    not self._load_lazy_bundle(name):
+                raise
+            return self._named_bundles[name]
+
+    def __contains__(self, name):
+        return name in self._named_bundles or name in self._lazy_bundles
 
-    def from_yaml(self, path):
-        """Register bundles from a YAML configuration file"""
-        bundles = YAMLLoader(path).load_bundles()
-        for name in bundles:
-            self.register(name, bundles[name])
+    def __iter__(self):
+        self.load_lazy_bundles()
+        return chain(self._named_bundles.values(), self._anon_bundles)
 
-    def from_module(self, path):
-        """Register bundles from a Python module"""
-        bundles = PythonLoader(path).load_bundles()
-        for name in bundles:
-            self.register(name, bundles[name])
+    def __len__(self):
+        self.load_lazy_bundles()
+        return len(self._named_bundles) + len(self._anon_bundles)
+
+
+class _Inotify(object):
+    """A minimal interface to the Linux inotify API, reporting the paths
+    of changed files in a set of watched directories.
+
+    Raises ``OSError`` if inotify is not available.
+    """
+
+    IN_MODIFY = 0x00000002
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_IGNORED = 0x00008000
+    IN_NONBLOCK = 0o4000
+    IN_CLOEXEC = 0o2000000
+
+    mask = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | \
+           IN_CREATE | IN_DELETE
+
+    def __init__(self):
+        if not sys.platform.startswith('linux'):
+            raise OSError('inotify is only available on Linux')
+        import ctypes
+        import ctypes.util
+        self._ctypes = ctypes
+        self._libc = ctypes.CDLL(ctypes.util.find_library('c'),
+                                 use_errno=True)
+        if not hasattr(self._libc, 'inotify_init1'):
+            raise OSError('inotify is not supported by the C library')
+        self.fd = self._check(self._libc.inotify_init1(
+            self.IN_NONBLOCK | self.IN_CLOEXEC))
+        self._watches = {}
+        self._directories = set()
+
+    def _check(self, result):
+        if result < 0:
+            errno = self._ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        return result
+
+    def close(self):
+        os.close(self.fd)
+
+    def watch(self, directory):
+        """Report changes to files in ``directory``."""
+        if directory in self._directories:
+            return
+        wd = self._check(self._libc.inotify_add_watch(
+            self.fd, os.fsencode(directory), self.mask))
+        self._watches[wd] = directory
+        self._directories.add(directory)
+
+    def read(self, timeout=None, delay=0):
+        """Wait up to ``timeout`` seconds for changes, and return the set
+        of changed paths.
+
+        Once a change has been seen, events are collected until none has
+        arrived for ``delay`` seconds, so that the multiple events caused
+        by an editor saving a file are reported at once.
+        """
+        changed = set()
+        wait = timeout
+        while True:
+            ready, _, _ = select.select([self.fd], [], [], wait)
+            if not ready:
+                return changed
+            changed.update(self._read_events())
+            wait = delay
+
+    def _read_events(self):
+        try:
+            data = os.read(self.fd, 65536)
+        except BlockingIOError:
+            return
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = struct.unpack_from('iIII', data, offset)
+            offset += 16
+            name = data[offset:offset + length].rstrip(b'\0')
+            offset += length
+            if mask & self.IN_IGNORED:
+                # The watched directory is gone.
+                self._directories.discard(self._watches.pop(wd, None))
+            elif name and wd in self._watches:
+                yield path.join(self._watches[wd], os.fsdecode(name))
 
 
 try:
@@ -380,16 +2311,219 @@ try:
 except ImportError:
     pass
 else:
-    def _webassets_cmd(cmd):
+    from webassets.script import (BuildCommand, CommandLineEnvironment,
+                                  WatchCommand)
+
+    class FlaskBuildCommand(BuildCommand):
+        """Adds the ability to build several bundles at the same time,
+        using a pool of ``jobs`` threads.
+
+        This is mostly useful when the filters run external processes.
+        Bundles with the same output target are still built one after
+        another. The result of each bundle is logged in the usual order.
+
+        Unless ``force`` is given, bundles are only rebuilt if the
+        configured updater says so; by default, this is only the case
+        with a :class:`ContentHashUpdater`.
+        """
+
+        def __call__(self, jobs=None, force=None, **kwargs):
+            env = self.environment
+            if force is None:
+                force = not isinstance(env.updater, ContentHashUpdater)
+            if (force and (not jobs or jobs < 2)) or \
+                    kwargs.get('output') or kwargs.get('directory'):
+                return super(FlaskBuildCommand, self).__call__(**kwargs)
+
+            if kwargs.get('production'):
+                env.debug = False
+
+            env.load_lazy_bundles()
+            names = dict((id(b), n) for n, b in env._named_bundles.items())
+            bundle_names = kwargs.get('bundles')
+            if bundle_names:
+                bundles = [b for n, b in env._named_bundles.items()
+                           if n in bundle_names]
+            else:
+                bundles = list(env)
+
+            # Bundles writing to the same file must not run concurrently.
+            groups = OrderedDict()
+            for bundle in bundles:
+                key = bundle.output or id(bundle)
+                groups.setdefault(key, []).append(bundle)
+
+            app = current_app._get_current_object()
+            no_cache = kwargs.get('no_cache')
+
+            def build_group(group):
+                results = []
+                with app.app_context(), env.build_context():
+                    for bundle in group:
+                        try:
+                            with bundle.bind(env):
+                                if not force and self.is_up_to_date(bundle):
+                                    results.append((bundle, None, True))
+                                    continue
+                                bundle.build(force=force,
+                                             disable_cache=no_cache)
+                        except BuildError as e:
+                            results.append((bundle, e, False))
+                        else:
+                            results.append((bundle, None, False))
+                return results
+
+            built = []
+            failed = []
+            with ThreadPoolExecutor(max_workers=jobs or 1) as executor:
+                futures = [executor.submit(build_group, group)
+                           for group in groups.values()]
+                for future in futures:
+                    for bundle, error, skipped in future.result():
+                        name = names.get(id(bundle))
+                        if skipped:
+                            self.log.info("Bundle is up to date: %s" % (
+                                name or bundle.output))
+                            continue
+                        if name:
+                            self.log.info("Building bundle: %s (to %s)" % (
+                                name, bundle.output))
+                        else:
+                            self.log.info("Building bundle: %s" % bundle.output)
+                        if error is not None:
+                            self.log.error("Failed, error was: %s" % error)
+                            failed.append(bundle)
+                        else:
+                            built.append(bundle)
+
+            if built:
+                self.event_handlers['post_build']()
+            if failed:
+                return 2
+
+        def is_up_to_date(self, bundle):
+            """Ask the updater whether ``bundle`` needs to be rebuilt."""
+            if bundle.is_container:
+                return False
+            ctx = wrap(self.environment, bundle)
+            if not ctx.updater:
+                return False
+            try:
+                if not path.exists(bundle.resolve_output(ctx)):
+                    return False
+            except BundleError:
+                return False
+            return not ctx.updater.needs_rebuild(bundle, ctx)
+
+    class FlaskWatchCommand(WatchCommand):
+        """Waits for changes to source files using inotify where available,
+        instead of polling their modification times, and falls back to
+        polling elsewhere.
+
+        Only the bundles affected by a change are rebuilt. Changes arriving
+        within ``delay`` seconds of each other cause a single rebuild.
+        """
+
+        delay = 0.1
+        # How often ``loop`` is called while no changes happen.
+        timeout = 1
+
+        def __call__(self, loop=None):
+            try:
+                inotify = _Inotify()
+            except OSError:
+                return super(FlaskWatchCommand, self).__call__(loop=loop)
+            try:
+                self.watch_with_inotify(inotify, loop)
+            finally:
+                inotify.close()
+
+        def map_files_to_watch(self, inotify):
+            files = {}
+            for filename, bundles in self.yield_files_to_watch():
+                filename = path.abspath(filename)
+                files.setdefault(filename, []).append(bundles)
+                inotify.watch(path.dirname(filename))
+            return files
+
+        def find_changed_bundles(self, filenames, files):
+            changed_bundles = set()
+            for filename in filenames:
+                for bundles_to_update in files.get(filename, ()):
+                    if callable(bundles_to_update):
+                        # Hook for when file has changed
+                        try:
+                            bundles_to_update = bundles_to_update()
+                        except EnvironmentError:
+                            import traceback
+                            traceback.print_exc()
+                            bundles_to_update = set()
+                    if bundles_to_update is True:
+                        bundles_to_update = set(self.environment)
+                    changed_bundles |= bundles_to_update
+            return changed_bundles
+
+        def watch_with_inotify(self, inotify, loop=None):
+            try:
+                files = self.map_files_to_watch(inotify)
+
+                for bundle in self.environment:
+                    print('Bringing up to date: %s' % bundle.output)
+                    bundle.build(force=False)
+
+                self.log.info("Watching %d bundles for changes..." %
+                              len(self.environment))
+
+                while True:
+                    changed = inotify.read(self.timeout, self.delay)
+                    changed_bundles = self.find_changed_bundles(changed, files)
+                    if any(f not in files for f in changed):
+                        # New files may be matched by a glob.
+                        files = self.map_files_to_watch(inotify)
+                        changed_bundles |= self.find_changed_bundles(
+                            changed, files)
+
+                    built = []
+                    for bundle in changed_bundles:
+                        print("Building bundle: %s ..." % bundle.output,
+                              end=' ')
+                        sys.stdout.flush()
+                        try:
+                            bundle.build(force=True)
+                            built.append(bundle)
+                        except BuildError as e:
+                            print("")
+                            print("Failed: %s" % e)
+                        else:
+                            print("done")
+
+                    if len(built):
+                        self.event_handlers['post_build']()
+
+                    if loop and loop():
+                        break
+            except KeyboardInterrupt:
+                pass
+
+    def _webassets_cmd(cmd, **kwargs):
         """Helper to run a webassets command."""
-        from webassets.script import CommandLineEnvironment
         logger = logging.getLogger('webassets')
         logger.addHandler(logging.StreamHandler())
         logger.setLevel(logging.DEBUG)
-        cmdenv = CommandLineEnvironment(
-            current_app.jinja_env.assets_environment, logger
-        )
-        getattr(cmdenv, cmd)()
+        env = current_app.jinja_env.assets_environment
+
+        def post_build():
+            env.clear_url_cache()
+            if env.config.get('url_manifest'):
+                env.write_url_manifest()
+            if env.config.get('precompress'):
+                env.precompress_outputs()
+
+        cmdenv = CommandLineEnvironment(env, logger, post_build=post_build,
+                                        commands={'build': FlaskBuildCommand,
+                                                  'watch': FlaskWatchCommand})
+        with env.build_context():
+            return getattr(cmdenv, cmd)(**kwargs)
 
 
     @click.group()
@@ -398,10 +2532,18 @@ else:
 
 
     @assets.command()
+    @click.option('--jobs', '-j', default=1, type=click.IntRange(min=1),
+                  help='Number of bundles to build at the same time.')
+    @click.option('--force/--no-force', default=None,
+                  help='Rebuild bundles even if their inputs did not '
+                       'change. This is the default unless the "content" '
+                       'updater is used.')
     @cli.with_appcontext
-    def build():
+    def build(jobs, force):
         """Build bundles."""
-        _webassets_cmd('build')
+        rv = _webassets_cmd('build', jobs=jobs, force=force)
+        if rv:
+            click.get_current_context().exit(rv)
 
 
     @assets.command()
@@ -0,0 +1,134 @@
+import gzip
+import logging
+import os
+import sys
+
+import pytest
+from webassets.script import CommandLineEnvironment
+
+from flask import Flask
+
+from flask_assets import ContentHashUpdater, Environment, FlaskWatchCommand, Jinja2Filter, assets
+from tests.helpers import create_files
+
+
+def test_build_jobs(app, env, temp_dir):
+    app.static_folder = temp_dir
+    create_files(temp_dir, "a", "b", "c")
+    env.register("a", "a", output="out_a")
+    env.register("b", "b", output="out_b")
+    env.register("c", "c", output="out_c")
+
+    result = app.test_cli_runner().invoke(assets, ["build", "--jobs", "3"])
+    assert result.exit_code == 0
+    for name in ("out_a", "out_b", "out_c"):
+        assert os.path.exists(os.path.join(temp_dir, name))
+
+
+def test_build_jobs_failure(app, env, temp_dir):
+    app.static_folder = temp_dir
+    create_files(temp_dir, "a")
+    env.register("a", "a", output="out_a")
+    env.register("missing", "missing", output="out_missing")
+
+    result = app.test_cli_runner().invoke(assets, ["build", "-j", "2"])
+    assert result.exit_code == 2
+    assert os.path.exists(os.path.join(temp_dir, "out_a"))
+
+
+
+@pytest.mark.skipif(not sys.platform.startswith("linux"), reason="requires inotify")
+def test_watch_inotify(app, env, temp_dir):
+    app.static_folder = temp_dir
+    create_files(temp_dir, "a", "b")
+    env.register("a", "a", output="out_a")
+    env.register("b", "b", output="out_b")
+
+    built = []
+    cmdenv = CommandLineEnvironment(env, logging.getLogger(__name__),
+                                    post_build=lambda: built.append(True),
+                                    commands={"watch": FlaskWatchCommand})
+    cmdenv.commands["watch"].timeout = 0.1
+
+    def loop():
+        if not os.path.getsize(os.path.join(temp_dir, "a")):
+            with open(os.path.join(temp_dir, "a"), "w", encoding="utf-8") as f:
+                f.write("changed")
+            return False
+        return True
+
+    with app.app_context():
+        cmdenv.watch(loop=loop)
+
+    with open(os.path.join(temp_dir, "out_a"), encoding="utf-8") as f:
+        assert f.read() == "changed"
+    # The change caused a single rebuild.
+    assert built == [True]
+
+
+def test_build_content_updater(app, env, temp_dir):
+    app.static_folder = temp_dir
+    a, b = create_files(temp_dir, "a", "b")
+    env.updater = "content"
+    jinja = Jinja2Filter(context={"foo": "bar"})
+    env.register("a", "a", output="out_a")
+    env.register("b", "b", filters=jinja, output="out_b")
+
+    def build(*args):
+        result = app.test_cli_runner().invoke(assets, ["build"] + list(args))
+        assert result.exit_code == 0
+        return [line for line in result.output.splitlines() if line.startswith("Building")]
+
+    assert len(build()) == 2
+    assert os.path.exists(os.path.join(temp_dir, ContentHashUpdater.default_filename))
+
+    # Unchanged inputs are not rebuilt, even if the timestamps change.
+    os.utime(a, (0, 2 ** 31))
+    assert build() == []
+
+    with open(b, "w", encoding="utf-8") as f:
+        f.write("{{ foo }}")
+    assert build() == ["Building bundle: b (to out_b)"]
+
+    jinja.context["foo"] = "qux"
+    assert build("-j", "2") == ["Building bundle: b (to out_b)"]
+    with open(os.path.join(temp_dir, "out_b"), encoding="utf-8") as f:
+        assert f.read() == "qux"
+
+    assert len(build("--force")) == 2
+
+
+def test_build_precompress(temp_dir):
+    app = Flask(__name__, static_folder=temp_dir, static_url_path="/static")
+    app.config["ASSETS_PRECOMPRESS"] = ["gzip"]
+    app.config["ASSETS_SERVE_PRECOMPRESSED"] = True
+    env = Environment(app)
+    create_files(temp_dir, "a.css")
+    with open(os.path.join(temp_dir, "a.css"), "w", encoding="utf-8") as f:
+        f.write("body { color: red }")
+    env.register("a", "a.css", output="out.css")
+
+    result = app.test_cli_runner().invoke(assets, ["build"])
+    assert result.exit_code == 0
+    with gzip.open(os.path.join(temp_dir, "out.css.gz")) as f:
+        assert f.read() == b"body { color: red }"
+
+    client = app.test_client()
+    response = client.get("/static/out.css", headers={"Accept-Encoding": "gzip"})
+    assert response.headers["Content-Encoding"] == "gzip"
+    assert response.mimetype == "text/css"
+    assert "Accept-Encoding" in response.headers["Vary"]
+    assert gzip.decompress(response.data) == b"body { color: red }"
+    response.close()
+
+    response = client.get("/static/out.css")
+    assert "Content-Encoding" not in response.headers
+    assert response.data == b"body { color: red }"
+    response.close()
+
+
+def test_precompress_unavailable_encoding(app, env):
+    app.config["ASSETS_PRECOMPRESS"] = ["zstd"]
+    with app.app_context():
+        with pytest.raises(EnvironmentError):
+            env.precompress_outputs()
@@ -51,3 +51,23 @@ def test_config_isolation_within_apps(no_app_env):
     app2 = Flask(__name__)
     with app2.test_request_context():
         assert no_app_env.config["foo"] == "bar"
+
+
+def test_config_fallback_cache(app, no_app_env):
+    no_app_env.config.setdefault("foo", "bar")
+    with app.test_request_context():
+        assert no_app_env.config["foo"] == "bar"
+        assert no_app_env.config.get("missing") is None
+        assert no_app_env._get_app_state(app).config["foo"] == "bar"
+
+        # Values written to the app config directly are always seen.
+        app.config["FOO"] = "direct"
+        assert no_app_env.config["foo"] == "direct"
+        del no_app_env.config["foo"]
+        assert no_app_env._get_app_state(app).config is None
+        assert no_app_env.config["foo"] == "bar"
+
+    # New defaults invalidate the cached values.
+    no_app_env.config.setdefault("missing", "now-set")
+    with app.test_request_context():
+        assert no_app_env.config["missing"] == "now-set"
@@ -1,7 +1,11 @@
+import json
 import os
+import sys
 import types
 
-from flask_assets import Bundle
+import pytest
+
+from flask_assets import Bundle, Environment
 
 
 def test_assets_tag(app, env):
@@ -32,3 +36,83 @@ def test_from_yaml(app, env):
         assert template.render() == "/app_static/yaml_file1;/app_static/yaml_file2;"
     finally:
         os.remove("test.yaml")
+
+
+def test_url_manifest(app, env, temp_dir):
+    app.config["ASSETS_URL_MANIFEST"] = os.path.join(temp_dir, "urls.json")
+    env.register("test", "file1", "file2", extra={"media": "print"})
+    env.write_url_manifest()
+    with open(app.config["ASSETS_URL_MANIFEST"]) as f:
+        assert json.load(f) == {"test": [["/app_static/file1", None], ["/app_static/file2", None]]}
+
+    # A new environment loads the manifest in init_app, and uses it
+    # without asking the resolver.
+    env2 = Environment()
+    env2.register("test", "file1", "file2", extra={"media": "print"})
+    env2.init_app(app)
+    template = app.jinja_env.from_string(
+        "{% assets 'test' %}{{ASSET_URL}} {{EXTRA.media}};{% endassets %}")
+    with app.app_context():
+        env2.resolver = None
+        assert template.render() == "/app_static/file1 print;/app_static/file2 print;"
+
+
+def test_url_manifest_missing(app, env, temp_dir):
+    app.config["ASSETS_URL_MANIFEST"] = os.path.join(temp_dir, "urls.json")
+    assert env.load_url_manifest() is False
+    env.register("test", "file1")
+    template = app.jinja_env.from_string("{% assets 'test' %}{{ASSET_URL}};{% endassets %}")
+    assert template.render() == "/app_static/file1;"
+
+
+def test_from_yaml_lazy(app, env, temp_dir, monkeypatch):
+    filename = os.path.join(temp_dir, "assets.yaml")
+    with open(filename, "w", encoding="utf-8") as f:
+        f.write("""
+        js:
+            contents:
+                - file1
+                - lib
+        lib:
+            contents: file2
+        """)
+    env.from_yaml(filename, lazy=True)
+    assert "js" in env and "lib" in env
+    assert not env._named_bundles
+
+    template = app.jinja_env.from_string('{% assets "js" %}{{ASSET_URL}};{% endassets %}')
+    assert template.render() == "/app_static/file1;/app_static/file2;"
+    assert isinstance(env["js"], Bundle)
+    assert env["js"].contents[1] is env["lib"]
+
+    # The parsed file is cached, and used while the file is unchanged.
+    cache = os.path.join(temp_dir, ".assets.yaml.cache.json")
+    assert os.path.exists(cache)
+    import yaml
+    monkeypatch.setattr(yaml, "safe_load", None)
+    env2 = Environment(app)
+    env2.from_yaml(filename, lazy=True)
+    assert len(env2) == 2
+
+    # Only changed content is parsed again, not a changed timestamp.
+    os.utime(filename, (0, 0))
+    Environment(app).from_yaml(filename, lazy=True)
+    with open(filename, "a", encoding="utf-8") as f:
+        f.write("        css:\n            contents: file3\n")
+    with pytest.raises(TypeError):
+        Environment(app).from_yaml(filename, lazy=True)
+
+
+def test_from_module_lazy(app, env, temp_dir, monkeypatch):
+    with open(os.path.join(temp_dir, "lazy_assets.py"), "w", encoding="utf-8") as f:
+        f.write("from flask_assets import Bundle\n"
+                "js = Bundle('py_file1', 'py_file2')\n")
+    monkeypatch.syspath_prepend(temp_dir)
+    env.from_module("lazy_assets", lazy=True)
+    assert "js" in env
+    assert "lazy_assets" not in sys.modules
+
+    template = app.jinja_env.from_string('{% assets "js" %}{{ASSET_URL}};{% endassets %}')
+    assert template.render() == "/app_static/py_file1;/app_static/py_file2;"
+    assert "lazy_assets" in sys.modules
+    monkeypatch.delitem(sys.modules, "lazy_assets")
@@ -1,9 +1,14 @@
 import os
+import re
+import sys
 
 import pytest
+from jinja2 import BytecodeCache
 from webassets.bundle import get_all_bundle_files
 
-from flask_assets import Bundle
+from flask import Flask
+
+from flask_assets import Bundle, Environment, FlaskResolver, Jinja2Filter, UrlBackend
 from tests.helpers import create_files, new_blueprint
 
 
@@ -164,3 +169,489 @@ def test_cssrewrite(app, env, temp_dir):
     # within the url space.
     with open(os.path.join(app.static_folder, "out"), "r") as f:
         assert f.read() == 'h1{background: url("../w/u/f/f/local")}'
+
+
+def test_url_cache(app, env, monkeypatch):
+    """Urls generated through the Flask system are memoized."""
+    calls = []
+    convert = env.resolver.convert_items_to_flask_urls
+    monkeypatch.setattr(env.resolver, "convert_items_to_flask_urls",
+                        lambda *a, **kw: calls.append(a) or convert(*a, **kw))
+
+    assert Bundle("foo", env=env).urls() == ["/app_static/foo"]
+    assert Bundle("foo", env=env).urls() == ["/app_static/foo"]
+    assert len(calls) == 1
+
+    # The root url of the current request is part of the key.
+    with app.test_request_context("/", environ_overrides={"SCRIPT_NAME": "/your_app"}):
+        assert Bundle("foo", env=env).urls() == ["/your_app/app_static/foo"]
+    assert len(calls) == 2
+
+    env.clear_url_cache()
+    assert Bundle("foo", env=env).urls() == ["/app_static/foo"]
+    assert len(calls) == 3
+
+    # The cache can be disabled.
+    app.config["ASSETS_URL_CACHE_SIZE"] = 0
+    Bundle("foo", env=env).urls()
+    Bundle("foo", env=env).urls()
+    assert len(calls) == 5
+
+
+def test_url_cache_is_bounded(app, env):
+    env.config["url_cache_size"] = 2
+    for name in ("a", "b", "c"):
+        Bundle(name, env=env).urls()
+    assert [key[0] for key in env._get_app_state(app).url_cache] == ["b", "c"]
+
+
+def test_blueprint_index(app, env):
+    """The blueprint index is rebuilt when blueprints are registered."""
+    assert Bundle("bp4/foo", env=env).urls() == ["/app_static/bp4/foo"]
+    index = env.resolver.get_blueprint_index(env)
+    assert env.resolver.get_blueprint_index(env) is index
+    assert index["bp"] == (app.blueprints["bp"].static_folder, "bp.static")
+
+    app.register_blueprint(new_blueprint("bp4", static_folder="static", static_url_path="/bp4_static"))
+    assert Bundle("bp4/foo", env=env).urls() == ["/bp4_static/foo"]
+
+
+def test_jinja2_filter_template_cache(app, env, temp_dir, monkeypatch):
+    """Jinja2Filter compiles each distinct source only once."""
+    app.static_folder = temp_dir
+    app.config["ASSETS_CACHE"] = False
+    app.config["ASSETS_MANIFEST"] = False
+    for name in ("a", "b"):
+        with open(os.path.join(temp_dir, name), "w", encoding="utf-8") as f:
+            f.write("{{ foo }}")
+
+    compiled = []
+    compile = app.jinja_env.compile
+    monkeypatch.setattr(app.jinja_env, "compile",
+                        lambda *a, **kw: compiled.append(a) or compile(*a, **kw))
+
+    bundle = Bundle("a", "b", filters=Jinja2Filter(context={"foo": "bar"}), output="out", env=env)
+    with app.app_context():
+        bundle.build(force=True)
+        bundle.build(force=True)
+    with open(os.path.join(temp_dir, "out"), encoding="utf-8") as f:
+        assert f.read() == "bar\nbar"
+    assert len(compiled) == 1
+
+
+def test_jinja2_filter_bytecode_cache(app, env, temp_dir):
+    class MemoryCache(BytecodeCache):
+        def __init__(self):
+            self.data = {}
+
+        def load_bytecode(self, bucket):
+            if bucket.key in self.data:
+                bucket.bytecode_from_string(self.data[bucket.key])
+
+        def dump_bytecode(self, bucket):
+            self.data[bucket.key] = bucket.bytecode_to_string()
+
+    app.static_folder = temp_dir
+    app.config["ASSETS_CACHE"] = False
+    app.config["ASSETS_MANIFEST"] = False
+    with open(os.path.join(temp_dir, "a"), "w", encoding="utf-8") as f:
+        f.write("{{ foo }}")
+
+    cache = MemoryCache()
+    bundle = Bundle("a", filters=Jinja2Filter(context={"foo": "bar"}, bytecode_cache=cache),
+                    output="out", env=env)
+    with app.app_context():
+        bundle.build(force=True)
+    assert len(cache.data) == 1
+    with open(os.path.join(temp_dir, "out"), encoding="utf-8") as f:
+        assert f.read() == "bar"
+
+
+@pytest.mark.parametrize("stream", [True, "config"])
+def test_jinja2_filter_stream(app, env, temp_dir, monkeypatch, stream):
+    """Jinja2Filter can write its output in chunks."""
+    app.static_folder = temp_dir
+    with open(os.path.join(temp_dir, "a"), "w", encoding="utf-8") as f:
+        f.write("{% for i in range(3) %}{{ foo }}{{ i }}{% endfor %}")
+
+    if stream == "config":
+        app.config["JINJA2_STREAM"] = True
+        jinja = Jinja2Filter(context={"foo": "bar"})
+    else:
+        jinja = Jinja2Filter(context={"foo": "bar"}, stream=True)
+
+    generated = []
+    monkeypatch.setattr(jinja, "get_template", lambda *a: TemplateSpy(app.jinja_env.from_string(a[1]), generated))
+    with app.app_context():
+        Bundle("a", filters=jinja, output="out", env=env).build(force=True)
+    with open(os.path.join(temp_dir, "out"), encoding="utf-8") as f:
+        assert f.read() == "bar0bar1bar2"
+    assert generated == [True]
+
+
+class TemplateSpy(object):
+    def __init__(self, template, generated):
+        self.template = template
+        self.generated = generated
+
+    def generate(self, *args, **kwargs):
+        self.generated.append(True)
+        return self.template.generate(*args, **kwargs)
+
+
+def test_build_context(app, env, monkeypatch):
+    """A single request context is used for all urls within build_context()."""
+    pushed = []
+    test_request_context = app.test_request_context
+    monkeypatch.setattr(app, "test_request_context",
+                        lambda *a, **kw: pushed.append(True) or test_request_context(*a, **kw))
+    app.config["ASSETS_URL_CACHE_SIZE"] = 0
+
+    assert Bundle("a", "b", env=env).urls() == ["/app_static/a", "/app_static/b"]
+    assert len(pushed) == 2
+
+    with env.build_context():
+        assert Bundle("a", "b", "bp/c", env=env).urls() == ["/app_static/a", "/app_static/b", "/bp_static/c"]
+        with env.build_context():
+            Bundle("a", env=env).urls()
+    assert len(pushed) == 3
+
+
+class PrefixUrlBackend(UrlBackend):
+    def __init__(self):
+        self.batches = []
+
+    def url_for(self, endpoint, filename):
+        return "https://cdn.example.com/%s/%s" % (endpoint, filename)
+
+    def urls_for(self, items):
+        self.batches.append(items)
+        return super(PrefixUrlBackend, self).urls_for(items)
+
+
+def test_url_backend(app, env, monkeypatch):
+    """Custom url backends can be registered."""
+    backend = PrefixUrlBackend()
+    monkeypatch.setitem(FlaskResolver.url_backends, "prefix", lambda app: backend)
+    app.config["ASSETS_URL_BACKEND"] = "prefix"
+    env.clear_url_cache()
+
+    assert Bundle("foo", "bp/bar", env=env).urls() == [
+        "https://cdn.example.com/static/foo", "https://cdn.example.com/bp.static/bar"]
+
+    app.config["ASSETS_URL_BACKEND"] = "unknown"
+    env.clear_url_cache()
+    with pytest.raises(EnvironmentError):
+        Bundle("foo", env=env).urls()
+
+
+def test_url_backend_batches(app, env, temp_dir):
+    """In debug mode, the urls of the source files of a bundle rendered
+    by the template tag are generated at once."""
+    app.static_folder = temp_dir
+    create_files(temp_dir, "a.js", "b.js", "c.js")
+    backend = PrefixUrlBackend()
+    app.config["ASSETS_URL_BACKEND"] = backend
+    env.clear_url_cache()
+    env.debug = True
+    env.register("js", Bundle("*.js"), "bp/d.js")
+
+    template = app.jinja_env.from_string("{% assets 'js' %}{{ASSET_URL}};{% endassets %}")
+    assert template.render() == "".join("https://cdn.example.com/%s;" % f for f in (
+        "static/a.js", "static/b.js", "static/c.js", "bp.static/d.js"))
+    assert len(backend.batches) == 1
+    assert len(backend.batches[0]) == 4
+
+    # All urls are cached now.
+    template.render()
+    assert len(backend.batches) == 1
+
+
+def test_hash_outputs(app, env, temp_dir):
+    """With ASSETS_HASH_OUTPUTS, output filenames contain a content hash,
+    and are served with far-future cache headers."""
+    bp5_static_folder = os.path.join(temp_dir, "bp5_static")
+    os.mkdir(bp5_static_folder)
+    app.register_blueprint(new_blueprint("bp5", static_folder=bp5_static_folder, static_url_path="/bp5_static"))
+    app.static_folder = temp_dir
+    create_files(temp_dir, "a.js", "b.css")
+    app.config["ASSETS_HASH_OUTPUTS"] = True
+
+    env.register("js", "a.js", output="bp5/gen/packed.js")
+    env.register("css", "b.css", output="gen/packed.css")
+    assert env["js"].output == "bp5/gen/packed.%(version)s.js"
+
+    template = app.jinja_env.from_string("{% assets 'js', 'css' %}{{ASSET_URL}};{% endassets %}")
+    js_url, css_url = template.render().split(";")[:2]
+    assert re.match(r"^/bp5_static/gen/packed\.[0-9a-f]{8}\.js$", js_url)
+    assert re.match(r"^/app_static/gen/packed\.[0-9a-f]{8}\.css$", css_url)
+    assert os.path.exists(os.path.join(bp5_static_folder, "gen", js_url.rsplit("/", 1)[1]))
+
+    client = app.test_client()
+    for url in (js_url, css_url):
+        response = client.get(url)
+        assert response.status_code == 200
+        assert response.headers["Cache-Control"] == "public, max-age=31536000, immutable"
+        response.close()
+
+    response = client.get("/app_static/a.js")
+    assert "immutable" not in response.headers.get("Cache-Control", "")
+    response.close()
+
+
+@pytest.mark.parametrize("spill_size", [None, 0])
+def test_in_memory(temp_dir, spill_size):
+    """With ASSETS_IN_MEMORY, outputs are served from memory."""
+    app = Flask(__name__, static_folder=temp_dir)
+    app.config["ASSETS_IN_MEMORY"] = True
+    app.config["ASSETS_IN_MEMORY_SPILL_SIZE"] = spill_size
+    env = Environment(app)
+    (a,) = create_files(temp_dir, "a.js")
+    with open(a, "w", encoding="utf-8") as f:
+        f.write("var a;")
+    env.register("js", "a.js", output="gen/packed.%(version)s.js")
+
+    template = app.jinja_env.from_string("{% assets 'js' %}{{ASSET_URL}}{% endassets %}")
+    url = template.render()
+    assert re.match(r"^/_assets/gen/packed\.[0-9a-f]{8}\.js$", url)
+    assert not os.path.exists(os.path.join(temp_dir, "gen"))
+
+    client = app.test_client()
+    response = client.get(url)
+    assert response.status_code == 200
+    assert response.get_data() == b"var a;"
+    assert response.mimetype in ("application/javascript", "text/javascript")
+    assert response.headers["Cache-Control"] == "public, max-age=31536000, immutable"
+    etag = response.headers["ETag"]
+    response.close()
+    response = client.get(url, headers={"If-None-Match": etag})
+    assert response.status_code == 304
+    response.close()
+
+    # Changing the source results in a new output; the old one is gone.
+    with open(a, "w", encoding="utf-8") as f:
+        f.write("var b;")
+    os.utime(a, (0, os.path.getmtime(a) + 10))
+    new_url = template.render()
+    assert new_url != url
+    assert client.get(url).status_code == 404
+    assert client.get(new_url).get_data() == b"var b;"
+
+
+def test_instrumentation(app, env, temp_dir):
+    """Builds and url generation are reported through signals, and
+    counted by the environment."""
+    from flask_assets import bundle_build_finished, bundle_build_started, url_cache_hit, url_resolved
+
+    app.static_folder = temp_dir
+    a, b = create_files(temp_dir, "a.js", "b.js")
+    with open(a, "w", encoding="utf-8") as f:
+        f.write("var a;")
+    env.register("js", Bundle("a.js", "b.js", output="packed.js"))
+    env.config["url_expire"] = False
+
+    events = []
+
+    def record(name):
+        def receiver(sender, **kwargs):
+            assert sender is env
+            events.append((name, kwargs))
+        return receiver
+
+    receivers = [(bundle_build_started, record("started")),
+                 (bundle_build_finished, record("finished")),
+                 (url_resolved, record("resolved")),
+                 (url_cache_hit, record("hit"))]
+    for signal, receiver in receivers:
+        signal.connect(receiver)
+    try:
+        template = app.jinja_env.from_string("{% assets 'js' %}{{ASSET_URL}}{% endassets %}")
+        assert template.render() == "/app_static/packed.js"
+        assert template.render() == "/app_static/packed.js"
+    finally:
+        for signal, receiver in receivers:
+            signal.disconnect(receiver)
+
+    # The bundle is only built once, as it is up to date afterwards.
+    names = [name for name, _ in events]
+    assert names == ["started", "finished", "resolved", "hit"]
+    finished = events[1][1]
+    assert finished["bundle"] is env["js"]
+    assert finished["bytes_in"] == finished["bytes_out"] - 1 == 6
+    assert finished["exception"] is None
+    assert events[2][1]["url"] == "/app_static/packed.js"
+
+    stats = env.get_stats()
+    assert stats["bundles"]["js"]["builds"] == 1
+    assert stats["bundles"]["js"]["bytes_out"] == 7
+    assert stats["bundles"]["js"]["files_resolved"] == 2
+    assert stats["urls"]["url_cache_hits"] == 1
+    assert stats["urls"]["url_cache_misses"] == 1
+    assert stats["urls"]["urls_resolved"] == 1
+
+    env.reset_stats()
+    assert env.get_stats() == {"bundles": {}, "urls": dict.fromkeys(env.url_stats_keys, 0)}
+
+
+def test_prewarm(temp_dir):
+    """With ASSETS_PREWARM, bundles are built in a background thread, and
+    requests wait for it rather than building them again."""
+    import time
+
+    def slow(_in, out, **kw):
+        time.sleep(0.2)
+        out.write(_in.read())
+
+    app = Flask(__name__, static_folder=temp_dir, static_url_path="/static")
+    app.config["ASSETS_PREWARM"] = True
+    create_files(temp_dir, "a.js", "b.js")
+    env = Environment()
+    env.register("a", Bundle("a.js", filters=slow, output="out_a.js"))
+    env.register("b", Bundle("b.js", filters=slow, output="out_b.js"))
+    env.init_app(app)
+
+    template = app.jinja_env.from_string("{% assets 'b' %}{{ASSET_URL}}{% endassets %}")
+    with app.test_request_context():
+        assert template.render().startswith("/static/out_b.js")
+        env.wait_for_prewarm()
+        stats = env.get_stats()["bundles"]
+    assert stats["a"]["builds"] == stats["b"]["builds"] == 1
+    assert os.path.exists(os.path.join(temp_dir, "out_a.js"))
+
+    # Bundles registered later on are prewarmed as well.
+    create_files(temp_dir, "c.js")
+    env.register("c", Bundle("c.js", output="out_c.js"))
+    with app.app_context():
+        env.wait_for_prewarm()
+    assert os.path.exists(os.path.join(temp_dir, "out_c.js"))
+
+
+@pytest.mark.parametrize("file_lock", [False, True])
+def test_concurrent_builds(app, env, temp_dir, file_lock):
+    """Concurrent renders of a bundle build it only once."""
+    import threading
+    import time
+
+    if file_lock and sys.platform.startswith("win"):
+        pytest.skip("requires fcntl")
+
+    def slow(_in, out, **kw):
+        time.sleep(0.1)
+        out.write(_in.read())
+
+    app.static_folder = temp_dir
+    app.config["ASSETS_BUILD_FILE_LOCK"] = file_lock
+    create_files(temp_dir, "a.js")
+    env.register("a", Bundle("a.js", filters=slow, output="gen/out_a.js"))
+    template = app.jinja_env.from_string("{% assets 'a' %}{{ASSET_URL}}{% endassets %}")
+
+    results = []
+
+    def render():
+        with app.test_request_context():
+            results.append(template.render())
+
+    threads = [threading.Thread(target=render) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(results) == 4
+    assert env.get_stats()["bundles"]["a"]["builds"] == 1
+    # Only the output (and the lock file) are left behind.
+    expected = {"out_a.js", ".out_a.js.lock"} if file_lock else {"out_a.js"}
+    assert set(os.listdir(os.path.join(temp_dir, "gen"))) == expected
+
+
+def test_app_state_isolation(temp_dir):
+    """A shared environment keeps the state of each app separately, and
+    drops it along with the app."""
+    import gc
+
+    env = Environment()
+    env.register("js", "a.js")
+    template = "{% assets 'js' %}{{ASSET_URL}}{% endassets %}"
+
+    apps = []
+    for i in range(2):
+        app = Flask(__name__, static_url_path="/static%d" % i)
+        env.init_app(app)
+        apps.append(app)
+        with app.test_request_context():
+            assert app.jinja_env.from_string(template).render() == "/static%d/a.js" % i
+    for i, app in enumerate(apps):
+        cache = env._get_app_state(app).url_cache
+        assert list(cache.values()) == ["/static%d/a.js" % i]
+    assert len(env._app_states) == 2
+
+    del app, apps[:]
+    gc.collect()
+    assert len(env._app_states) == 0
+
+
+def test_glob_cache(app, env, temp_dir, monkeypatch):
+    """Glob results are cached until a directory they depend on changes."""
+    from webassets.env import Resolver
+
+    app.static_folder = temp_dir
+    os.makedirs(os.path.join(temp_dir, "js", "a"))
+    os.makedirs(os.path.join(temp_dir, "js", "b"))
+    create_files(temp_dir, "js/a/1.js", "js/b/2.js", "js/b/3.css")
+    for directory in ("js", "js/a", "js/b"):
+        os.utime(os.path.join(temp_dir, directory), (0, 1))
+
+    globs = []
+    original = Resolver.glob
+    monkeypatch.setattr(Resolver, "glob", lambda self, *args: globs.append(args) or original(self, *args))
+
+    def files():
+        return [os.path.relpath(f, temp_dir).replace(os.sep, "/")
+                for f in env.resolver.search_for_source(env, "js/*/*.js")]
+
+    assert files() == ["js/a/1.js", "js/b/2.js"]
+    assert files() == ["js/a/1.js", "js/b/2.js"]
+    assert len(globs) == 1
+
+    # Adding a file changes the mtime of its directory.
+    create_files(temp_dir, "js/b/4.js")
+    assert files() == ["js/a/1.js", "js/b/2.js", "js/b/4.js"]
+    assert len(globs) == 2
+
+
+def test_async(app, env, temp_dir):
+    """Bundles are built in the background for async callers, and
+    concurrent callers share a single build."""
+    import asyncio
+    import threading
+    import time
+
+    threads = set()
+
+    def slow(_in, out, **kw):
+        threads.add(threading.current_thread())
+        time.sleep(0.1)
+        out.write(_in.read())
+
+    app.static_folder = temp_dir
+    app.config["ASSETS_URL_EXPIRE"] = False
+    create_files(temp_dir, "a.js")
+    env.register("a", Bundle("a.js", filters=slow, output="out_a.js"))
+    jinja_env = app.jinja_env.overlay(enable_async=True)
+    template = jinja_env.from_string("{% assets 'a' %}{{ASSET_URL}};{% endassets %}")
+
+    async def main():
+        return await asyncio.gather(
+            env.urls_async("a"), env.urls_async(env["a"]), template.render_async())
+
+    with app.test_request_context():
+        urls, urls2, rendered = asyncio.run(main())
+    assert urls == urls2 == [{"uri": "/app_static/out_a.js", "sri": urls[0]["sri"]}]
+    assert rendered == "/app_static/out_a.js;"
+    assert threading.current_thread() not in threads
+    assert env.get_stats()["bundles"]["a"]["builds"] == 1
+
+    with app.app_context():
+        hunks = asyncio.run(env.build_async("a", force=True))
+    assert len(hunks) == 1
+    assert env.get_stats()["bundles"]["a"]["builds"] == 2